@@ -1,9 +1,25 @@
 import requests
+import contextvars
+import html
+import logging
 import os
+import re
+import threading
 import time
+from collections import OrderedDict, deque
+from concurrent import futures
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse
 
+from requests.adapters import HTTPAdapter
 from telegram import Chat
 
+import deadline
+import route_optimizer
+import tracing
+
+DIRECTORY_URL = os.environ.get('DIRECTORY_URL', 'https://dir.aviapages.com:443')
+CALCULATOR_URL = os.environ.get('CALCULATOR_URL', 'https://frc.aviapages.com:443')
 HEADERS = {
     'Content-Type': 'application/json',
     'Authorization': f'Token {os.environ.get("API_TOKEN")}'
@@ -13,19 +29,412 @@ CALCULATOR_PARAMETERS = {
     "airway_distance": True
 }
 
+# Upstream concurrency limits (per host)
+CONCURRENCY_INITIAL_LIMIT = int(os.environ.get('CONCURRENCY_INITIAL_LIMIT', 4))
+CONCURRENCY_MIN_LIMIT = int(os.environ.get('CONCURRENCY_MIN_LIMIT', 1))
+CONCURRENCY_MAX_LIMIT = int(os.environ.get('CONCURRENCY_MAX_LIMIT', 32))
+
+# Worker threads for concurrent upstream calls
+API_WORKERS = int(os.environ.get('API_WORKERS', 16))
+MAX_COMPARISON_OPTIONS = 12
+MAX_ROUTE_AIRPORTS = 12
+# Telegram message length limit
+MESSAGE_LIMIT = 4096
+
+# Lookup caches (entries count and lifetime in seconds), shared by all bots of the process
+AIRPORT_CACHE_SIZE = int(os.environ.get('AIRPORT_CACHE_SIZE', 5000))
+AIRPORT_CACHE_TTL = int(os.environ.get('AIRPORT_CACHE_TTL', 24 * 60 * 60))
+CALCULATOR_CACHE_SIZE = int(os.environ.get('CALCULATOR_CACHE_SIZE', 20000))
+CALCULATOR_CACHE_TTL = int(os.environ.get('CALCULATOR_CACHE_TTL', 6 * 60 * 60))
+
+# Hedged directory lookups: duplicate request is sent when the first one is slower than the percentile
+HEDGE_REQUESTS = os.environ.get('HEDGE_REQUESTS', '').lower() in ('1', 'true', 'yes')
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 0.9))
+# Max share of requests that may be hedged, also caps extra concurrent load put on upstream by hedges
+HEDGE_MAX_RATE = float(os.environ.get('HEDGE_MAX_RATE', 0.1))
+
+logger = logging.getLogger('AVIAPAGES API')
+
+EXECUTOR = ThreadPoolExecutor(max_workers=API_WORKERS, thread_name_prefix='aviapages')
+
+
+def submit(function, *args) -> Future:
+    return EXECUTOR.submit(tracing.bind(function), *args)
+
+
+class Abort:
+    """
+    Lets the hedger give up a request that lost the race.
+    Its limiter slot is returned at once and its late reply is not counted by the limiter.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.aborted = False
+        self.on_abort = None
+
+    def attach(self, on_abort) -> bool:
+        # False if the request was aborted before it got a slot
+        with self.lock:
+            if self.aborted:
+                return False
+            self.on_abort = on_abort
+            return True
+
+    def detach(self) -> bool:
+        # False if the slot was already returned by abort
+        with self.lock:
+            self.on_abort = None
+            return not self.aborted
+
+    def abort(self) -> None:
+        with self.lock:
+            self.aborted = True
+            on_abort, self.on_abort = self.on_abort, None
+        if on_abort is not None:
+            on_abort()
+
+
+_current_abort = contextvars.ContextVar('current_abort', default=None)
+
+
+class Hedger:
+    """
+    Sends a duplicate of a slow idempotent request, the first successful reply wins.
+    Hedge delay is the tracked percentile of recent latency, hedge rate is limited with a token bucket.
+    """
+
+    MIN_SAMPLES = 20
+    MAX_TOKENS = 10.0
+
+    def __init__(self, percentile: float = HEDGE_PERCENTILE, max_rate: float = HEDGE_MAX_RATE, samples: int = 200):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=samples)
+        self.tokens = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.executor = ThreadPoolExecutor(max_workers=API_WORKERS * 2, thread_name_prefix='aviapages-hedge')
+
+    def get_delay(self):
+        with self.lock:
+            if len(self.latencies) < self.MIN_SAMPLES:
+                return None
+            latencies = sorted(self.latencies)
+            return latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile))]
+
+    def add_latency(self, latency: float) -> None:
+        with self.lock:
+            self.latencies.append(latency)
+
+    def call(self, function, *args):
+        with self.lock:
+            self.requests += 1
+            self.tokens = min(self.MAX_TOKENS, self.tokens + self.max_rate)
+
+        delay = self.get_delay()
+        primary, primary_abort = self._submit(function, *args)
+        if delay is None:
+            return primary.result()
+
+        done, _ = futures.wait([primary], timeout=delay)
+        if len(done) > 0:
+            return primary.result()
+
+        with self.lock:
+            allowed = self.tokens >= 1
+            if allowed:
+                self.tokens -= 1
+                self.hedges += 1
+        if not allowed:
+            return primary.result()
+        hedge, hedge_abort = self._submit(function, *args)
+
+        error = None
+        for future in futures.as_completed([primary, hedge]):
+            if future.exception() is not None:
+                error = error or future.exception()
+                continue
+            # Loser is cancelled if not started yet, otherwise its slot is returned and its reply is dropped
+            (hedge if future is primary else primary).cancel()
+            (hedge_abort if future is primary else primary_abort).abort()
+            if future is hedge:
+                with self.lock:
+                    self.hedge_wins += 1
+            return future.result()
+        raise error
+
+    def _submit(self, function, *args) -> tuple:
+        started = time.perf_counter()
+        abort = Abort()
+
+        def run(*run_args):
+            _current_abort.set(abort)
+            return function(*run_args)
+
+        future = self.executor.submit(tracing.bind(run), *args)
+
+        def track(completed: Future) -> None:
+            if not completed.cancelled() and completed.exception() is None:
+                self.add_latency(time.perf_counter() - started)
+
+        future.add_done_callback(track)
+        return future, abort
+
+    def metrics(self) -> dict:
+        delay = self.get_delay()
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'hedges': self.hedges,
+                'hedge_wins': self.hedge_wins,
+                'delay_ms': round(delay * 1000, 1) if delay is not None else None
+            }
+
+
+HEDGER = Hedger()
+
+
+# Shared connection pool for all upstream requests
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_maxsize=CONCURRENCY_MAX_LIMIT))
+SESSION.mount('http://', HTTPAdapter(pool_maxsize=CONCURRENCY_MAX_LIMIT))
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limiter for one upstream host.
+    The limit grows additively while short-term latency stays close to the long-term baseline
+    and is cut multiplicatively on rising latency, 429, 5xx or connection errors.
+    """
+
+    LATENCY_TOLERANCE = 2.0
+    LATENCY_BACKOFF = 0.9
+    FAILURE_BACKOFF = 0.5
+    SMOOTHING = 0.2
+    BASELINE_SMOOTHING = 0.01
+
+    def __init__(self, initial_limit: int = CONCURRENCY_INITIAL_LIMIT, min_limit: int = CONCURRENCY_MIN_LIMIT, max_limit: int = CONCURRENCY_MAX_LIMIT):
+        self.condition = threading.Condition()
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.latency = None
+        self.baseline_latency = None
+        self.last_decrease = 0.0
+
+    def acquire(self, timeout: float = None) -> bool:
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency: float, status_code) -> None:
+        with self.condition:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+
+            if status_code is None or status_code == 429 or status_code >= 500:
+                self._decrease(self.FAILURE_BACKOFF)
+            else:
+                # Short and long moving averages, jitter moves both the same way
+                if self.latency is None:
+                    self.latency = self.baseline_latency = latency
+                else:
+                    self.latency += self.SMOOTHING * (latency - self.latency)
+                    self.baseline_latency += self.BASELINE_SMOOTHING * (latency - self.baseline_latency)
+
+                if self.latency > self.baseline_latency * self.LATENCY_TOLERANCE:
+                    self._decrease(self.LATENCY_BACKOFF)
+                elif saturated:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+    def cancel(self) -> None:
+        # Slot is returned without a request, nothing is learned
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def _decrease(self, factor: float) -> None:
+        # Only one decrease per latency interval, one burst of failures is one congestion signal
+        now = time.monotonic()
+        if now - self.last_decrease < (self.latency or 0.0):
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * factor)
+
+    def metrics(self) -> dict:
+        with self.condition:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None
+            }
+
+
+LIMITERS = {}
+LIMITERS_LOCK = threading.Lock()
+
+
+class TTLCache:
+    """
+    Thread safe LRU cache with limited entries lifetime.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+AIRPORT_CACHE = TTLCache(AIRPORT_CACHE_SIZE, AIRPORT_CACHE_TTL)
+CALCULATOR_CACHE = TTLCache(CALCULATOR_CACHE_SIZE, CALCULATOR_CACHE_TTL)
+AVOID_CACHE = TTLCache(AIRPORT_CACHE_SIZE, AIRPORT_CACHE_TTL)
+
+
+def get_limiter(request_url: str) -> AdaptiveLimiter:
+    host = urlparse(request_url).netloc
+    with LIMITERS_LOCK:
+        if host not in LIMITERS:
+            LIMITERS[host] = AdaptiveLimiter()
+        return LIMITERS[host]
+
+
+def get_upstream_metrics() -> dict:
+    with LIMITERS_LOCK:
+        limiters = dict(LIMITERS)
+    return {host: limiter.metrics() for host, limiter in limiters.items()}
+
+
+def api_request(method: str, request_url: str, stage: str, **kwargs) -> requests.Response:
+    limiter = get_limiter(request_url)
+    if not limiter.acquire(deadline.get_timeout(stage)):
+        raise deadline.DeadlineExceeded()
+    # Hedged request that already lost returns its slot without sending anything
+    abort = _current_abort.get()
+    if abort is not None and not abort.attach(limiter.cancel):
+        limiter.cancel()
+        raise RuntimeError('❗️ Request aborted ❗️')
+
+    def finish(latency: float = None, status_code=None) -> None:
+        # Slot of an aborted request is already returned, its result teaches nothing
+        if abort is not None and not abort.detach():
+            return
+        if latency is None:
+            limiter.cancel()
+        else:
+            limiter.release(latency, status_code)
+
+    # Time spent waiting for the limiter is taken from the budget
+    try:
+        timeout = deadline.get_timeout(stage)
+    except deadline.DeadlineExceeded:
+        finish()
+        raise
+    started = time.perf_counter()
+    try:
+        response = SESSION.request(method, request_url, headers=HEADERS, timeout=timeout, **kwargs)
+    except requests.Timeout:
+        logger.warning(f'[{tracing.current_trace_id()}] {method} {request_url} timed out after {timeout:.1f}s')
+        # Running out of the update budget says nothing about upstream congestion
+        if deadline.is_clipped(stage, timeout):
+            finish()
+        else:
+            finish(time.perf_counter() - started)
+        raise deadline.DeadlineExceeded()
+    except requests.RequestException:
+        finish(time.perf_counter() - started)
+        logger.exception(f'[{tracing.current_trace_id()}] {method} {request_url} failed')
+        raise RuntimeError('❗️ Connection failure ❗️')
+    finish(time.perf_counter() - started, response.status_code)
+    return response
+
+
+def api_get(request_url: str, stage: str = 'directory') -> requests.Response:
+    with tracing.span('GET', request_url):
+        return api_request('GET', request_url, stage)
+
+
+def api_get_hedged(request_url: str, stage: str = 'directory') -> requests.Response:
+    # Only idempotent lookups may be hedged
+    if not HEDGE_REQUESTS:
+        return api_get(request_url, stage)
+    return HEDGER.call(api_get, request_url, stage)
+
+
+def api_post(request_url: str, json: dict, stage: str = 'calculator') -> requests.Response:
+    with tracing.span('POST', request_url):
+        return api_request('POST', request_url, stage, json=json)
+
+
+class CalculatorError(RuntimeError):
+    """
+    Flight calculator rejected the leg (out of range, weight exceeded, etc.)
+    """
+
 
 def get_airport_parameters(query: str, airport_type: str) -> dict:
+    airport = AIRPORT_CACHE.get(query)
+    if airport is not None:
+        return airport
+    with tracing.span('get_airport_parameters', query):
+        airport = _get_airport_parameters(query, airport_type)
+    AIRPORT_CACHE.put(query, airport)
+    return airport
+
+
+def _get_airport_parameters(query: str, airport_type: str) -> dict:
 
     request_urls = (
-        f'https://dir.aviapages.com:443/api/airports/?search_iata={query}',
-        f'https://dir.aviapages.com:443/api/airports/?search_icao={query}',
-        f'https://dir.aviapages.com:443/api/airports/?search_name={query}'
+        f'{DIRECTORY_URL}/api/airports/?search_iata={query}',
+        f'{DIRECTORY_URL}/api/airports/?search_icao={query}',
+        f'{DIRECTORY_URL}/api/airports/?search_name={query}'
     )
 
     result = {}
 
     for request_url in request_urls:
-        request = requests.get(url=request_url, headers=HEADERS)
+        request = api_get_hedged(request_url)
         if request.status_code == 200:
             request_json = request.json()
             for request_result in request_json.get('results'):
@@ -46,15 +455,15 @@ def get_airport_parameters(query: str, airport_type: str) -> dict:
 def get_aircraft_parameters(query: str) -> dict:
 
     request_urls = (
-        f'https://dir.aviapages.com:443/api/aircraft_profiles/?search_name={query}',
-        f'https://dir.aviapages.com:443/api/aircraft_profiles/?search_aircraft_type_name={query}',
-        f'https://dir.aviapages.com:443/api/aircraft_profiles/?search_aircraft_type_icao={query}'
+        f'{DIRECTORY_URL}/api/aircraft_profiles/?search_name={query}',
+        f'{DIRECTORY_URL}/api/aircraft_profiles/?search_aircraft_type_name={query}',
+        f'{DIRECTORY_URL}/api/aircraft_profiles/?search_aircraft_type_icao={query}'
     )
 
     result = {}
 
     for request_url in request_urls:
-        request = requests.get(url=request_url, headers=HEADERS)
+        request = api_get(request_url)
         if request.status_code == 200:
             request_json = request.json()
             if request_json.get('count') > 0:
@@ -70,17 +479,26 @@ def get_aircraft_parameters(query: str) -> dict:
 
 
 def get_avoid_parameters(avoid: set) -> dict:
+    with tracing.span('get_avoid_parameters', ', '.join(avoid)):
+        return _get_avoid_parameters(avoid)
+
+
+def _get_avoid_parameters(avoid: set) -> dict:
     avoid_countries = []
     avoid_firs = []
     for query in avoid:
-        request_url = f'https://dir.aviapages.com:443/api/countries/?search={query}'
-        request = requests.get(url=request_url, headers=HEADERS)
-        if request.status_code == 200:
-            request_json = request.json()
-            if request_json.get('count') > 0:
-                avoid_countries.append(query)
-            else:
-                avoid_firs.append(query)
+        avoid_type = AVOID_CACHE.get(query)
+        if avoid_type is None:
+            request_url = f'{DIRECTORY_URL}/api/countries/?search={query}'
+            request = api_get_hedged(request_url, 'avoid')
+            if request.status_code == 200:
+                request_json = request.json()
+                avoid_type = 'countries' if request_json.get('count') > 0 else 'firs'
+                AVOID_CACHE.put(query, avoid_type)
+        if avoid_type == 'countries':
+            avoid_countries.append(query)
+        elif avoid_type == 'firs':
+            avoid_firs.append(query)
 
     return {
         'countries': avoid_countries,
@@ -89,42 +507,254 @@ def get_avoid_parameters(avoid: set) -> dict:
 
 
 def generate_calculator_message(userdata: Chat, query: list) -> str:
-    airway_total_time = 0
-    airway_total_distance = 0
-    all_warnings = ''
+    return render_calculator_message(calculate_legs(userdata, query))
+
+
+def calculate_legs(userdata: Chat, query: list, previous_query: list = None, previous_legs: list = None) -> list:
+    # Legs already calculated for the previous version of the query are reused
+    previous_results = {}
+    if previous_query is not None and previous_legs is not None:
+        for query_params, leg in zip(previous_query, previous_legs):
+            previous_results[get_leg_key(query_params)] = leg
+
+    legs = [previous_results.get(get_leg_key(query_params)) for query_params in query]
 
-    flight_info = ''
+    # Comparison is always the only leg and fans out by itself
+    if len(query) == 1 and legs[0] is None and is_comparison(query[0]):
+        return [calculate_comparison(userdata, query[0])]
 
-    single_line = len(query) == 1
+    futures = {index: submit(calculate_leg, userdata, query[index]) for index in range(len(query)) if legs[index] is None}
+    done, _ = deadline.wait(list(futures.values()))
+    for index, future in futures.items():
+        if future not in done:
+            continue
+        error = future.exception()
+        if error is None:
+            legs[index] = future.result()
+        elif not isinstance(error, deadline.DeadlineExceeded):
+            raise error
 
-    for query_params in query:
-        departure_airport = get_airport_parameters(query_params.get('departure_airport'), 'Departure')
-        arrival_airport = get_airport_parameters(query_params.get('arrival_airport'), 'Arrival')
-        passengers_count = query_params.get('pax')
-        aircraft = query_params.get('aircraft')
-        avoid = get_avoid_parameters(query_params.get('avoid'))
+    # Legs not calculated within the deadline stay None
+    if all(leg is None for leg in legs):
+        raise deadline.DeadlineExceeded()
+    return legs
 
-        calculated_parameters = calculate_flight_parameters(get_user_info(userdata), departure_airport, arrival_airport, aircraft, passengers_count, avoid)
-        airway_total_time += calculated_parameters.get("airway_time")
-        airway_total_distance += calculated_parameters.get("airway_distance")
-        for warning in calculated_parameters.get('warnings'):
-            if warning not in all_warnings:
-                all_warnings += f'{warning}\n'
 
+def get_leg_key(query_params: dict) -> tuple:
+    # Line count does not affect calculation
+    return (query_params.get('departure_airport'),
+            query_params.get('arrival_airport'),
+            tuple(get_comparison_options(query_params)),
+            frozenset(query_params.get('avoid')))
+
+
+def calculate_leg(userdata: Chat, query_params: dict) -> dict:
+    departure_airport = get_airport_parameters(query_params.get('departure_airport'), 'Departure')
+    arrival_airport = get_airport_parameters(query_params.get('arrival_airport'), 'Arrival')
+    passengers_count = query_params.get('pax')
+    aircraft = query_params.get('aircraft')
+    avoid = get_avoid_parameters(query_params.get('avoid'))
+
+    calculated_parameters = calculate_flight_parameters(get_user_info(userdata), departure_airport, arrival_airport, aircraft, passengers_count, avoid)
+
+    return {
+        'departure_airport': departure_airport,
+        'arrival_airport': arrival_airport,
+        'pax': passengers_count,
+        'aircraft': aircraft,
+        'avoid': avoid,
+        'airway_time': calculated_parameters.get('airway_time'),
+        'airway_distance': calculated_parameters.get('airway_distance'),
+        'warnings': calculated_parameters.get('warnings')
+    }
+
+
+def is_comparison(query_params: dict) -> bool:
+    return isinstance(query_params.get('aircraft'), list) or isinstance(query_params.get('pax'), list)
+
+
+def get_comparison_options(query_params: dict) -> list:
+    aircraft_list = query_params.get('aircraft') if isinstance(query_params.get('aircraft'), list) else [query_params.get('aircraft')]
+    pax_list = query_params.get('pax') if isinstance(query_params.get('pax'), list) else [query_params.get('pax')]
+    # Identical options are calculated once
+    return list(dict.fromkeys((aircraft, pax) for aircraft in aircraft_list for pax in pax_list))
+
+
+def calculate_comparison(userdata: Chat, query_params: dict) -> dict:
+    options = get_comparison_options(query_params)
+    if len(options) > MAX_COMPARISON_OPTIONS:
+        raise RuntimeError(f'⚠️ Too many options to compare (max {MAX_COMPARISON_OPTIONS}) ⚠️')
+
+    # Route is resolved once for all options
+    departure_airport = get_airport_parameters(query_params.get('departure_airport'), 'Departure')
+    arrival_airport = get_airport_parameters(query_params.get('arrival_airport'), 'Arrival')
+    avoid = get_avoid_parameters(query_params.get('avoid'))
+
+    username = get_user_info(userdata)
+    futures = [submit(calculate_comparison_option, username, departure_airport, arrival_airport, aircraft, pax, avoid) for aircraft, pax in options]
+
+    done, _ = deadline.wait(futures)
+
+    return {
+        'departure_airport': departure_airport,
+        'arrival_airport': arrival_airport,
+        'avoid': avoid,
+        'options': [future.result() if future in done else {'aircraft': aircraft, 'pax': pax, 'error': '⏱ Timed out'}
+                    for future, (aircraft, pax) in zip(futures, options)]
+    }
+
+
+def calculate_comparison_option(username: str, departure: dict, arrival: dict, aircraft: str, pax: int, avoid: dict) -> dict:
+    option = {
+        'aircraft': aircraft,
+        'pax': pax
+    }
+    # One failed option (e.g. weight exceeded) does not fail the whole comparison
+    try:
+        option.update(calculate_flight_parameters(username, departure, arrival, aircraft, pax, avoid))
+    except RuntimeError as e:
+        option['error'] = ' '.join(e.args[0].replace('⚠️', '').split())
+    return option
+
+
+def format_airway_time(airway_time: int) -> str:
+    return time.strftime("%H:%M", time.gmtime(airway_time * 60)) if airway_time > 0 else '00:00'
+
+
+def get_comparison_message_parts(comparison: dict) -> list:
+    all_warnings = dict.fromkeys(warning for option in comparison.get('options') for warning in option.get('warnings', []))
+
+    departure = get_airport_title(comparison.get('departure_airport'))
+    arrival = get_airport_title(comparison.get('arrival_airport'))
+    avoid_message = generate_avoid_message(comparison.get('avoid'))
+
+    aircraft_width = max(len('AIRCRAFT'), *(len(option.get('aircraft')) for option in comparison.get('options')))
+    rows = [f'{"AIRCRAFT".ljust(aircraft_width)}  PAX   TIME  DISTANCE\n']
+    for option in comparison.get('options'):
+        row = f'{option.get("aircraft").ljust(aircraft_width)}  {str(option.get("pax")).rjust(3)}'
+        if 'error' in option:
+            row += f'  {option.get("error")}'
+        else:
+            row += f'  {format_airway_time(option.get("airway_time"))}  {str(int(option.get("airway_distance"))).rjust(6)}km'
+        rows.append(f'{row}\n')
+
+    parts = ['✅ <b>FLIGHT COMPARISON</b> ✅\n']
+    parts += [f'<b>{html.escape(warning)}</b>\n' for warning in all_warnings]
+    parts.append('\n')
+    parts.append(f' ┌ {departure} ➡️ {arrival}\n')
+    if len(avoid_message) > 0:
+        parts.append(f' ├ {avoid_message}\n')
+    parts.append(' └ <b>Options</b>:\n')
+    parts.append(f'<pre>{html.escape("".join(rows))}</pre>')
+    return parts
+
+
+def get_calculator_message_parts(legs: list) -> list:
+    """
+    Message split into parts with closed HTML tags, so it could be divided between several telegram messages.
+    """
+    if len(legs) == 1 and 'options' in legs[0]:
+        return get_comparison_message_parts(legs[0])
+
+    calculated_legs = [leg for leg in legs if leg is not None]
+    timed_out_legs = [str(index + 1) for index, leg in enumerate(legs) if leg is None]
+    single_line = len(legs) == 1
+
+    airway_total_time = sum(leg.get('airway_time') for leg in calculated_legs)
+    airway_total_distance = sum(leg.get('airway_distance') for leg in calculated_legs)
+    # Ordered set, each warning is shown once
+    all_warnings = dict.fromkeys(warning for leg in calculated_legs for warning in leg.get('warnings'))
+
+    parts = ['✅ <b>FLIGHT INFO</b> ✅\n']
+    parts += [f'<b>{html.escape(warning)}</b>\n' for warning in all_warnings]
+    if len(timed_out_legs) > 0:
+        parts.append(f'<b>⏱ Timed out, not calculated leg(s): {", ".join(timed_out_legs)}</b>\n')
+    parts.append('\n')
+
+    for index, leg in enumerate(calculated_legs):
+        flight_info = generate_flight_info_message(leg.get('departure_airport'), leg.get('arrival_airport'), leg.get('pax'), leg.get('aircraft'), leg.get('avoid'), single_line)
         if not single_line:
-            if len(flight_info) == 0:
-                flight_info += ' ┌ '
-            else:
-                flight_info += ' ├ '
-        flight_info += generate_flight_info_message(departure_airport, arrival_airport, passengers_count, aircraft, avoid, single_line)
+            flight_info = (' ┌ ' if index == 0 else ' ├ ') + flight_info
+        parts.append(flight_info)
+
+    parts.append(f' ├ <b>Flight time</b>: {format_airway_time(airway_total_time)}\n')
+    parts.append(f' └ <b>Flight distance</b>: {int(airway_total_distance)}km')
+    return parts
+
+
+def render_calculator_message(legs: list) -> str:
+    return ''.join(get_calculator_message_parts(legs))
+
+
+def render_calculator_messages(legs: list) -> list:
+    return split_message_parts(get_calculator_message_parts(legs))
+
+
+def split_message_parts(parts: list, limit: int = MESSAGE_LIMIT) -> list:
+    """
+    Joins message parts into as few messages as possible, each message is not longer than limit.
+    """
+    messages = []
+    current = []
+    current_length = 0
+    for part in parts:
+        for piece in split_html_part(part, limit) if len(part) > limit else [part]:
+            if current_length + len(piece) > limit and len(current) > 0:
+                messages.append(''.join(current))
+                current, current_length = [], 0
+            current.append(piece)
+            current_length += len(piece)
+
+    if len(current) > 0:
+        messages.append(''.join(current))
+    return messages
+
+
+def split_html_part(part: str, limit: int) -> list:
+    """
+    Cuts part longer than limit into pieces with closed HTML tags, preferably after a line end.
+    Tags and entities are never cut, tags open at a cut are closed and reopened in the next piece.
+    """
+    pieces = []
+    open_tags = []
+    current = []
+    current_length = 0
+    # Reopened tags at the start of the current piece and the last line end position with tags open there
+    reopened = 0
+    line_end = None
+    for token in re.findall(r'<[^>]*>|&#?\w+;|.', part, re.DOTALL):
+        if token.startswith('</'):
+            next_open_tags = open_tags[:-1]
+        elif token.startswith('<'):
+            next_open_tags = open_tags + [token]
+        else:
+            next_open_tags = open_tags
+
+        while current_length + len(token) + len(get_closing_tags(next_open_tags)) > limit and len(current) > reopened:
+            cut, cut_open_tags = line_end if line_end is not None else (len(current), open_tags)
+            pieces.append(''.join(current[:cut]) + get_closing_tags(cut_open_tags))
+            current = cut_open_tags + current[cut:]
+            current_length = sum(len(item) for item in current)
+            reopened = len(cut_open_tags)
+            line_end = None
+
+        current.append(token)
+        current_length += len(token)
+        open_tags = next_open_tags
+        if token == '\n':
+            line_end = (len(current), open_tags)
+
+    if len(current) > reopened:
+        pieces.append(''.join(current))
+    return pieces
+
 
-    airway_time = time.strftime("%H:%M", time.gmtime(airway_total_time * 60)) if airway_total_time > 0 else '00:00'
+def get_closing_tags(open_tags: list) -> str:
+    return ''.join(f'</{tag[1:-1].split()[0]}>' for tag in reversed(open_tags))
 
-    return f'✅ <b>FLIGHT INFO</b> ✅\n' \
-           f'<b>{all_warnings}</b>\n' \
-           f'{flight_info}' \
-           f' ├ <b>Flight time</b>: {airway_time}\n' \
-           f' └ <b>Flight distance</b>: {int(airway_total_distance)}km'
+
+def get_airport_title(airport: dict) -> str:
+    return f'{airport.get("airport_icao")} ({airport.get("airport_iata")}), {airport.get("airport_name")}'
 
 
 def get_user_info(userdata: Chat) -> str:
@@ -133,11 +763,11 @@ def get_user_info(userdata: Chat) -> str:
     
 
 def generate_flight_info_message(departure_airport: dict, arrival_airport: dict, passengers_count: int, aircraft: str, avoid: dict, single_line: bool) -> str:
-    departure = f'{departure_airport.get("airport_icao")} ({departure_airport.get("airport_iata")}), {departure_airport.get("airport_name")}'
-    arrival = f'{arrival_airport.get("airport_icao")} ({arrival_airport.get("airport_iata")}), {arrival_airport.get("airport_name")}'
+    departure = get_airport_title(departure_airport)
+    arrival = get_airport_title(arrival_airport)
     avoid_message = generate_avoid_message(avoid)
     if len(avoid_message) > 0:
-        avoid_message = f' ├ {generate_avoid_message(avoid)}\n'
+        avoid_message = f' ├ {avoid_message}\n'
 
     if single_line:
         flight_info = f' ┌ {departure} ➡️ {arrival}\n' \
@@ -152,18 +782,19 @@ def generate_flight_info_message(departure_airport: dict, arrival_airport: dict,
 def generate_avoid_message(avoid: dict) -> str:
     avoid_message = ''
     if len(avoid.get('countries')) > 0:
-        avoid_message += '🛑 <b>Avoided countries</b>: '
-        for country in avoid.get('countries'):
-            avoid_message += country + '; '
+        avoid_message += '🛑 <b>Avoided countries</b>: ' + ''.join(f'{country}; ' for country in avoid.get('countries'))
     if len(avoid.get('firs')) > 0:
-        avoid_message += '🛑 <b>Avoided FIRs</b>: '
-        for fir in avoid.get('firs'):
-            avoid_message += fir + '; '
+        avoid_message += '🛑 <b>Avoided FIRs</b>: ' + ''.join(f'{fir}; ' for fir in avoid.get('firs'))
 
     return avoid_message
 
 
 def calculate_flight_parameters(username: str, departure: dict, arrival: dict, aircraft: str, pax: int, avoid: dict) -> dict:
+    with tracing.span('calculate_flight_parameters', f'{get_airport_find_parameter(departure)}-{get_airport_find_parameter(arrival)} {aircraft}'):
+        return _calculate_flight_parameters(username, departure, arrival, aircraft, pax, avoid)
+
+
+def _calculate_flight_parameters(username: str, departure: dict, arrival: dict, aircraft: str, pax: int, avoid: dict) -> dict:
 
     query = {
         'departure_airport': get_airport_find_parameter(departure),
@@ -178,15 +809,15 @@ def calculate_flight_parameters(username: str, departure: dict, arrival: dict, a
     # Additional parameters for query
     query.update(CALCULATOR_PARAMETERS)
 
-    request_url = f'https://frc.aviapages.com:443/flight_calculator/'
-    request = requests.post(url=request_url, headers=HEADERS, json=query)
+    request_url = f'{CALCULATOR_URL}/flight_calculator/'
+    request = api_post(request_url, query)
     if request.status_code == 200:
         request_json = request.json()
         if 'errors' in request_json.keys():
             error_message = ''
             for error in request_json.get('errors'):
                 error_message += f'{error.get("message")}\n'
-            raise RuntimeError(f'⚠️\n{error_message}⚠️')
+            raise CalculatorError(f'⚠️\n{error_message}⚠️')
         else:
             return {
                 'airway_time': request_json.get('time').get('airway'),
@@ -197,6 +828,93 @@ def calculate_flight_parameters(username: str, departure: dict, arrival: dict, a
         raise RuntimeError('❗️ Connection failure ❗️')
 
 
+def calculate_flight_parameters_cached(username: str, departure: dict, arrival: dict, aircraft: str, pax: int, avoid: dict) -> dict:
+    key = (get_airport_find_parameter(departure),
+           get_airport_find_parameter(arrival),
+           aircraft,
+           pax,
+           tuple(sorted(avoid.get('countries'))),
+           tuple(sorted(avoid.get('firs'))))
+    calculated_parameters = CALCULATOR_CACHE.get(key)
+    if calculated_parameters is None:
+        try:
+            calculated_parameters = calculate_flight_parameters(username, departure, arrival, aircraft, pax, avoid)
+        except CalculatorError as e:
+            # Impossible leg is remembered, connection failures and timeouts are not
+            calculated_parameters = {'error': e.args[0]}
+        CALCULATOR_CACHE.put(key, calculated_parameters)
+    if 'error' in calculated_parameters:
+        raise CalculatorError(calculated_parameters.get('error'))
+    return calculated_parameters
+
+
+def calculate_route(userdata: Chat, query_params: dict) -> list:
+    """
+    Fastest order to visit all arrival airports from departure airport.
+    Returns legs in the same format as calculate_leg.
+    """
+    destinations = list(dict.fromkeys(query_params.get('arrival_airports')))
+    if len(destinations) > MAX_ROUTE_AIRPORTS:
+        raise RuntimeError(f'⚠️ Too many airports to visit (max {MAX_ROUTE_AIRPORTS}) ⚠️')
+
+    airport_futures = [submit(get_airport_parameters, query_params.get('departure_airport'), 'Departure')]
+    airport_futures += [submit(get_airport_parameters, destination, 'Arrival') for destination in destinations]
+    avoid = get_avoid_parameters(query_params.get('avoid'))
+    _, not_done = deadline.wait(airport_futures)
+    if len(not_done) > 0:
+        raise deadline.DeadlineExceeded('⏱ Route calculation timed out ⏱')
+
+    # Same airport could be passed as ICAO, IATA or name, duplicates and origin are removed
+    airports = {}
+    for future in airport_futures:
+        airport = future.result()
+        airports.setdefault(get_airport_find_parameter(airport), airport)
+    airports = list(airports.values())
+    if len(airports) < 2:
+        raise ValueError('⚠️ Invalid query ⚠️')
+
+    matrix = get_route_matrix(userdata, airports, query_params.get('aircraft'), query_params.get('pax'), avoid)
+    with tracing.span('route_optimizer', f'{len(airports) - 1} airports'):
+        order, _ = route_optimizer.solve([[leg.get('airway_time') if leg else None for leg in row] for row in matrix])
+
+    legs = []
+    previous = 0
+    for node in order:
+        leg = dict(matrix[previous][node])
+        leg['departure_airport'] = airports[previous]
+        leg['arrival_airport'] = airports[node]
+        leg['pax'] = query_params.get('pax')
+        leg['aircraft'] = query_params.get('aircraft')
+        leg['avoid'] = avoid
+        legs.append(leg)
+        previous = node
+    return legs
+
+
+def get_route_matrix(userdata: Chat, airports: list, aircraft: str, pax: int, avoid: dict) -> list:
+    # Pairwise legs, nothing returns to the origin. Impossible legs are None
+    username = get_user_info(userdata)
+    futures = {}
+    for source in range(len(airports)):
+        for target in range(1, len(airports)):
+            if source != target:
+                futures[(source, target)] = submit(calculate_flight_parameters_cached, username, airports[source], airports[target], aircraft, pax, avoid)
+
+    _, not_done = deadline.wait(list(futures.values()))
+    if len(not_done) > 0:
+        raise deadline.DeadlineExceeded('⏱ Route calculation timed out ⏱')
+
+    matrix = [[None] * len(airports) for _ in airports]
+    for (source, target), future in futures.items():
+        try:
+            matrix[source][target] = future.result()
+        except deadline.DeadlineExceeded:
+            raise deadline.DeadlineExceeded('⏱ Route calculation timed out ⏱')
+        except CalculatorError:
+            matrix[source][target] = None
+    return matrix
+
+
 def get_airport_find_parameter(airport: dict) -> str:
     if airport.get('airport_icao'):
         return airport.get('airport_icao')
@@ -1,36 +1,103 @@
 import logging
 import os
+import threading
+import time
+from collections import OrderedDict
+
 import aviapages_api
+import deadline
+import query_log
+import tracing
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+from telegram.error import BadRequest
 from telegram import ParseMode
 
 logging.basicConfig(level=logging.INFO)
 
+# Telegram user ids allowed to run operator commands
+ADMIN_IDS = {int(user_id) for user_id in os.environ.get('ADMIN_IDS', '').split(',') if user_id.strip().isdigit()}
+# Count of last user messages remembered for incremental recalculation on edit
+QUERY_HISTORY_SIZE = int(os.environ.get('QUERY_HISTORY_SIZE', 1000))
 
-class TelegramBot:
-    def __init__(self):
-        logger = logging.getLogger('TELEGRAM BOT')
-
-        # Main telegram UPDATER
-        self.updater = Updater(token=os.environ.get('BOT_TOKEN'), use_context=True)
-        self.dispatcher = self.updater.dispatcher
 
-        # Handlers
-        handler = TelegramHandler()
-        self.dispatcher.add_handler(CommandHandler('start', handler.start))
-        self.dispatcher.add_handler(CommandHandler('help', handler.info_message))
-        self.dispatcher.add_handler(MessageHandler(Filters.text, handler.user_message))
-        self.dispatcher.add_handler(MessageHandler(Filters.command, handler.unknown))
-        self.dispatcher.add_error_handler(handler.error)
+class TelegramBot:
+    """
+    Runs one or several bots in one process.
+    Bots share aviapages connections, caches and workers, handlers are separate for each bot.
+    """
 
-        # Starting the bot
-        self.updater.start_polling()
+    def __init__(self, tokens: list = None):
+        logger = logging.getLogger('TELEGRAM BOT')
 
-        logger.info('Flight time calculator BOT started')
+        # Several tokens are separated with ","
+        if tokens is None:
+            tokens = [token.strip() for token in os.environ.get('BOT_TOKEN', '').split(',') if len(token.strip()) > 0]
+        if len(tokens) == 0:
+            raise ValueError('BOT_TOKEN is not set')
+
+        self.updaters = []
+        for token in tokens:
+            # Main telegram UPDATER
+            updater = Updater(token=token, use_context=True)
+            dispatcher = updater.dispatcher
+
+            # Handlers (bot id is a public part of the token)
+            handler = TelegramHandler(token.split(':')[0])
+            dispatcher.add_handler(CommandHandler('start', handler.start))
+            dispatcher.add_handler(CommandHandler('help', handler.info_message))
+            dispatcher.add_handler(CommandHandler('route', handler.route))
+            dispatcher.add_handler(CommandHandler('profile', handler.profile))
+            dispatcher.add_handler(CommandHandler('metrics', handler.metrics))
+            dispatcher.add_handler(MessageHandler(Filters.text, handler.user_message))
+            dispatcher.add_handler(MessageHandler(Filters.command, handler.unknown))
+            dispatcher.add_error_handler(handler.error)
+
+            # Starting the bot
+            updater.start_polling()
+            self.updaters.append(updater)
+
+            logger.info(f'Flight time calculator BOT {handler.name} started')
+
+
+class QueryHistory:
+    """
+    Last parsed queries with calculated legs and bot replies, by (chat id, user message id).
+    The oldest entries are dropped when the size limit is reached.
+    """
+
+    def __init__(self, size: int = QUERY_HISTORY_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, chat_id: int, message_id: int):
+        with self.lock:
+            entry = self.entries.get((chat_id, message_id))
+            if entry is not None:
+                self.entries.move_to_end((chat_id, message_id))
+            return entry
+
+    def put(self, chat_id: int, message_id: int, query: list, legs: list, reply_message_ids: list) -> None:
+        with self.lock:
+            self.entries[(chat_id, message_id)] = {
+                'query': query,
+                'legs': legs,
+                'reply_message_ids': reply_message_ids
+            }
+            self.entries.move_to_end((chat_id, message_id))
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.entries)
 
 
 class TelegramHandler:
 
+    def __init__(self, name: str = ''):
+        self.name = name
+        self.history = QueryHistory()
+
     @classmethod
     def start(cls, update, context) -> None:
         user = update.effective_chat
@@ -56,12 +123,173 @@ class TelegramHandler:
                                  text=f'<i>{error_message}</i>',
                                  parse_mode=ParseMode.HTML)
 
+    def user_message(self, update, context) -> None:
+        with tracing.start_trace(f'{self.name} user_message', update.update_id) as trace, deadline.start():
+            # User can edit message or send new
+            user_message = update.edited_message if update.message is None else update.message
+            record = {
+                'time': time.time(),
+                'trace_id': trace.trace_id,
+                'bot': self.name,
+                'chat_id': update.effective_chat.id,
+                'edited': update.message is None,
+                'text': user_message.text
+            }
+            try:
+                query, legs = self.process_user_message(update, context, user_message)
+                record['query'] = [dict(query_params, avoid=sorted(query_params.get('avoid'))) for query_params in query]
+                record['legs'] = legs
+            except Exception as e:
+                record['error'] = e.args[0] if len(e.args) > 0 else repr(e)
+                raise
+            finally:
+                record['timings'] = query_log.get_stage_timings(trace.spans)
+                record['total_ms'] = round(trace.elapsed() * 1000, 1)
+                query_log.log_query(record)
+
+    def process_user_message(self, update, context, user_message) -> tuple:
+        chat_id = update.effective_chat.id
+        with tracing.span('get_query_structure'):
+            query = get_query_structure(user_message.text)
+        deadline.check()
+
+        # Edited message: only changed legs are recalculated and the original reply is updated
+        previous = self.history.get(chat_id, user_message.message_id) if update.message is None else None
+        if previous is not None:
+            legs = aviapages_api.calculate_legs(update.effective_chat, query, previous.get('query'), previous.get('legs'))
+        else:
+            legs = aviapages_api.calculate_legs(update.effective_chat, query)
+        messages = aviapages_api.render_calculator_messages(legs)
+
+        with tracing.span('send_message'):
+            reply_message_ids = previous.get('reply_message_ids') if previous is not None else []
+            reply_message_ids = self.send_messages(context, chat_id, messages, reply_message_ids)
+
+        self.history.put(chat_id, user_message.message_id, query, legs, reply_message_ids)
+        return query, legs
+
     @classmethod
-    def user_message(cls, update, context) -> None:
-        # User can edit message or send new
-        query = get_query_structure(update.edited_message.text if update.message is None else update.message.text)
+    def send_messages(cls, context, chat_id: int, messages: list, reply_message_ids: list) -> list:
+        # Previous replies are edited in place, missing ones are sent and extra ones are removed
+        message_ids = []
+        for index, message in enumerate(messages):
+            if index < len(reply_message_ids):
+                try:
+                    context.bot.edit_message_text(chat_id=chat_id,
+                                                  message_id=reply_message_ids[index],
+                                                  text=message,
+                                                  parse_mode=ParseMode.HTML)
+                    message_ids.append(reply_message_ids[index])
+                    continue
+                except BadRequest as e:
+                    # Result is the same as before, otherwise reply was removed and new one is sent
+                    if 'not modified' in e.message:
+                        message_ids.append(reply_message_ids[index])
+                        continue
+            reply = context.bot.send_message(chat_id=chat_id,
+                                             text=message,
+                                             parse_mode=ParseMode.HTML)
+            message_ids.append(reply.message_id)
+
+        for message_id in reply_message_ids[len(messages):]:
+            try:
+                context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+            except BadRequest:
+                pass
+
+        return message_ids
+
+    def route(self, update, context) -> None:
+        if len(context.args) == 0:
+            context.bot.send_message(chat_id=update.effective_chat.id,
+                                     text='<i>Enter route in the format</i>:\n'
+                                          '/route [<b>DEPARTURE AIRPORT</b>] <b>-</b> [<b>AIRPORTS TO VISIT</b>] [<b>PASSENGER COUNT PAX*</b>] [<b>AIRCRAFT</b>] [<b>no COUNTRIES, FIRs</b>]<b>*</b>\n\n'
+                                          '<i>Example</i>:\n'
+                                          ' 🔘 /route KIV - RIX, VKO, GVA 3 E35L',
+                                     parse_mode=ParseMode.HTML)
+            return
+
+        with tracing.start_trace(f'{self.name} route', update.update_id) as trace, deadline.start():
+            record = {
+                'time': time.time(),
+                'trace_id': trace.trace_id,
+                'bot': self.name,
+                'chat_id': update.effective_chat.id,
+                'command': 'route',
+                'text': ' '.join(context.args)
+            }
+            try:
+                query_params, order, legs = self.process_route(update, context)
+                record['query'] = dict(query_params, avoid=sorted(query_params.get('avoid')))
+                record['order'] = order
+                record['legs'] = legs
+            except Exception as e:
+                record['error'] = e.args[0] if len(e.args) > 0 else repr(e)
+                raise
+            finally:
+                record['timings'] = query_log.get_stage_timings(trace.spans)
+                record['total_ms'] = round(trace.elapsed() * 1000, 1)
+                query_log.log_query(record)
+
+    def process_route(self, update, context) -> tuple:
+        with tracing.span('get_route_structure'):
+            query_params = get_route_structure(' '.join(context.args))
+        deadline.check()
+        legs = aviapages_api.calculate_route(update.effective_chat, query_params)
+        airports = [legs[0].get('departure_airport')] + [leg.get('arrival_airport') for leg in legs]
+        order = [aviapages_api.get_airport_find_parameter(airport) for airport in airports]
+        parts = [f'🧭 <b>Fastest route</b>: {" ➡️ ".join(order)}\n\n'] + aviapages_api.get_calculator_message_parts(legs)
+        with tracing.span('send_message'):
+            self.send_messages(context, update.effective_chat.id, aviapages_api.split_message_parts(parts), [])
+        return query_params, order, legs
+
+    @classmethod
+    def profile(cls, update, context) -> None:
+        # Operators only, other users see it as unknown command
+        if not is_admin(update):
+            cls.unknown(update, context)
+            return
+
+        if len(context.args) != 1 or not context.args[0].isdigit() or int(context.args[0]) == 0:
+            context.bot.send_message(chat_id=update.effective_chat.id,
+                                     text='⚠️ <i>Usage: /profile [REQUEST COUNT]</i> ⚠️',
+                                     parse_mode=ParseMode.HTML)
+            return
+
+        count = int(context.args[0])
+        chat_id = update.effective_chat.id
+
+        def send_summary(summary: str) -> None:
+            context.bot.send_message(chat_id=chat_id,
+                                     text=tracing.format_profile_summary(summary),
+                                     parse_mode=ParseMode.HTML)
+
+        tracing.PROFILER.arm(count, send_summary)
+        context.bot.send_message(chat_id=chat_id,
+                                 text=f'🔍 Profiling next <b>{count}</b> request(s)',
+                                 parse_mode=ParseMode.HTML)
+
+    @classmethod
+    def metrics(cls, update, context) -> None:
+        if not is_admin(update):
+            cls.unknown(update, context)
+            return
+
+        message = '📊 <b>UPSTREAM</b>\n'
+        for host, metrics in aviapages_api.get_upstream_metrics().items():
+            message += f' 🔘 {host}: limit {metrics.get("limit")}, in flight {metrics.get("in_flight")}, latency {metrics.get("latency_ms")}ms\n'
+        hedge_metrics = aviapages_api.HEDGER.metrics()
+        message += f' 🔘 Hedged lookups: {hedge_metrics.get("hedges")} of {hedge_metrics.get("requests")} requests, ' \
+                   f'{hedge_metrics.get("hedge_wins")} won, delay {hedge_metrics.get("delay_ms")}ms\n'
+        message += '\n📦 <b>CACHES</b>\n'
+        for name, cache in (('Airports', aviapages_api.AIRPORT_CACHE), ('Avoid', aviapages_api.AVOID_CACHE), ('Calculator', aviapages_api.CALCULATOR_CACHE)):
+            metrics = cache.metrics()
+            message += f' 🔘 {name}: {metrics.get("size")} entries, {metrics.get("hits")} hits, {metrics.get("misses")} misses\n'
+        if query_log.QUERY_LOG is not None:
+            message += '\n📝 <b>QUERY LOG</b>\n'
+            message += f' 🔘 Dropped records: {query_log.QUERY_LOG.dropped}\n'
         context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text=aviapages_api.generate_calculator_message(update.effective_chat, query),
+                                 text=message,
                                  parse_mode=ParseMode.HTML)
 
     @staticmethod
@@ -70,7 +298,9 @@ class TelegramHandler:
                   f'[<b>DEPARTURE AIRPORT</b>] <b>-</b> [<b>ARRIVAL AIRPORT</b>] [<b>PASSENGER COUNT PAX*</b>] [<b>AIRCRAFT</b>] [<b>no COUNTRIES, FIRs</b>]<b>*</b>\n\n' \
                   f'🟢 AIRPORT could be passed as ICAO/IATA/NAME\n' \
                   f'🟢 <b>*</b> - optional\n' \
-                  f'🟢 Use multilines to add leg(s)\n\n' \
+                  f'🟢 Use multilines to add leg(s)\n' \
+                  f'🟢 Use "/" to compare several passenger counts and " / " to compare several aircraft on one route\n' \
+                  f'🟢 Use /route to find the fastest order to visit several airports\n\n' \
                   f'<i>Examples</i>:\n' \
                   f' 🔘 UUWW - EVRA 2Pax Challenger 300\n' \
                   f' 🔘 KIV RIX 3 E35L\n' \
@@ -83,12 +313,18 @@ class TelegramHandler:
                   f' 🔘 1 KIV-RIX 3 E35L\n' \
                   f'       2 RIX-VKO 3 Challenger 300\n' \
                   f' 🔘 1) KIV-RIX 3 E35L\n' \
-                  f'       2) RIX-VKO 3 Challenger 300'
+                  f'       2) RIX-VKO 3 Challenger 300\n' \
+                  f' 🔘 KIV-RIX 3 E35L / CL30 / Global 5000\n' \
+                  f' 🔘 KIV-RIX 2/6 pax E35L / CL30'
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text=message,
                                  parse_mode=ParseMode.HTML)
 
 
+def is_admin(update) -> bool:
+    return update.effective_user is not None and update.effective_user.id in ADMIN_IDS
+
+
 def get_query_structure(text: str) -> list:
     query_structures = []
     query_parts = text.split('\n')
@@ -98,6 +334,10 @@ def get_query_structure(text: str) -> list:
 
     # Control checkout for counts
     if len(query_structures) > 1:
+        for query_part in query_structures:
+            if aviapages_api.is_comparison(query_part):
+                raise ValueError('⚠️ Aircraft comparison is supported for a single route only ⚠️')
+
         count_exists = False
         for query_part in query_structures:
             if query_part.get('count').isdigit():
@@ -115,6 +355,24 @@ def get_query_structure(text: str) -> list:
     return query_structures
 
 
+def get_route_structure(text: str) -> dict:
+    # Same format as a single leg, airports to visit are separated with ","
+    query_params = get_query_part_structure(text)
+    if aviapages_api.is_comparison(query_params):
+        raise ValueError('⚠️ Aircraft comparison is not supported for route ⚠️')
+
+    arrival_airports = [airport.strip() for airport in query_params.pop('arrival_airport').split(',')]
+    for airport in arrival_airports:
+        if len(airport) < 3:
+            raise ValueError('⚠️ Invalid query ⚠️')
+    arrival_airports = [airport for airport in arrival_airports if airport != query_params.get('departure_airport')]
+    if len(arrival_airports) == 0:
+        raise ValueError('⚠️ Invalid query ⚠️')
+    query_params['arrival_airports'] = arrival_airports
+
+    return query_params
+
+
 def get_query_part_structure(text: str) -> dict:
     invalid_query = '⚠️ Invalid query ⚠️'
 
@@ -169,14 +427,18 @@ def get_query_part_structure(text: str) -> dict:
     if len(arrival_airport) < 3 or len(text) == 0:
         raise ValueError(invalid_query)
 
-    # PASSENGER COUNT
+    # PASSENGER COUNT (several counts for comparison are separated with "/")
     text_len = len(text)
     pax = ''
+    pax_list = []
     for i in range(text_len):
         if i == text_len - 1:
             raise ValueError(invalid_query)
         elif text[i].isnumeric():
             pax += text[i]
+        elif text[i] == '/' and len(pax) > 0 and text[i+1].isnumeric():
+            pax_list.append(int(pax))
+            pax = ''
         else:
             # Current processing text update
             text = text[i:].strip()
@@ -184,6 +446,8 @@ def get_query_part_structure(text: str) -> dict:
 
     if len(pax) == 0:
         raise ValueError(invalid_query)
+    pax_list.append(int(pax))
+    pax_list = list(dict.fromkeys(pax_list))
 
     # Current processing text update
     if text[:3].upper() == 'PAX':
@@ -200,8 +464,12 @@ def get_query_part_structure(text: str) -> dict:
         else:
             aircraft += text[i]
 
-    if len(aircraft) < 3:
-        raise ValueError(invalid_query)
+    # Several aircraft for comparison are separated with " / ", "/" without spaces is a part of aircraft name (Hawker 800XP/850XP)
+    aircraft_list = [aircraft_name.strip().upper() for aircraft_name in ' '.join(aircraft.split()).split(' / ')]
+    aircraft_list = list(dict.fromkeys(aircraft_list))
+    for aircraft_name in aircraft_list:
+        if len(aircraft_name) < 3:
+            raise ValueError(invalid_query)
 
     # Current processing text update
     text = text[i+3:].strip()
@@ -223,8 +491,8 @@ def get_query_part_structure(text: str) -> dict:
         'count': count,
         'departure_airport': departure_airport.upper(),
         'arrival_airport': arrival_airport.upper(),
-        'pax': int(pax),
-        'aircraft': aircraft.strip().upper(),
+        'pax': pax_list[0] if len(pax_list) == 1 else pax_list,
+        'aircraft': aircraft_list[0] if len(aircraft_list) == 1 else aircraft_list,
         'avoid': avoid
     }
 
@@ -0,0 +1,87 @@
+import contextvars
+import os
+import threading
+import time
+from concurrent import futures
+from contextlib import contextmanager
+
+# Whole time budget for one telegram update, seconds
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', 30))
+# Timeout for one upstream call outside of any update
+API_TIMEOUT = float(os.environ.get('API_TIMEOUT', 30))
+# Share of the budget all calls of the stage may take together, counted from the first call of the stage
+STAGE_BUDGETS = {
+    'directory': 0.3,
+    'avoid': 0.2,
+    'calculator': 0.5
+}
+
+_current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+
+class DeadlineExceeded(RuntimeError):
+    def __init__(self, message: str = '⏱ Request timed out ⏱'):
+        super().__init__(message)
+
+
+class Deadline:
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires = time.monotonic() + budget
+        # Stage deadlines are shared by all threads working on the update
+        self.lock = threading.Lock()
+        self.stage_expires = {}
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def stage_timeout(self, stage: str) -> float:
+        return self.budget * STAGE_BUDGETS.get(stage, 1.0)
+
+    def timeout(self, stage: str) -> float:
+        now = time.monotonic()
+        with self.lock:
+            if stage not in self.stage_expires:
+                self.stage_expires[stage] = min(self.expires, now + self.stage_timeout(stage))
+            expires = self.stage_expires[stage]
+        if expires <= now:
+            raise DeadlineExceeded()
+        return expires - now
+
+
+@contextmanager
+def start(budget: float = None):
+    current = Deadline(REQUEST_DEADLINE if budget is None else budget)
+    token = _current_deadline.set(current)
+    try:
+        yield current
+    finally:
+        _current_deadline.reset(token)
+
+
+def check() -> None:
+    current = _current_deadline.get()
+    if current is not None and current.remaining() <= 0:
+        raise DeadlineExceeded()
+
+
+def get_timeout(stage: str) -> float:
+    current = _current_deadline.get()
+    return API_TIMEOUT if current is None else current.timeout(stage)
+
+
+def is_clipped(stage: str, timeout: float) -> bool:
+    # Less than half of the stage share was left, the timeout is caused by earlier work of the update, not by upstream
+    current = _current_deadline.get()
+    return current is not None and timeout < current.stage_timeout(stage) / 2
+
+
+def wait(pending: list) -> tuple:
+    """
+    Waits for futures until the deadline, futures not started by then are cancelled.
+    """
+    current = _current_deadline.get()
+    done, not_done = futures.wait(pending, timeout=None if current is None else current.remaining())
+    for future in not_done:
+        future.cancel()
+    return done, not_done
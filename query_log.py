@@ -0,0 +1,118 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger('QUERY LOG')
+
+QUERY_LOG_PATH = os.environ.get('QUERY_LOG_PATH', '')
+QUERY_LOG_MAX_BYTES = int(os.environ.get('QUERY_LOG_MAX_BYTES', 50 * 1024 * 1024))
+QUERY_LOG_BACKUP_COUNT = int(os.environ.get('QUERY_LOG_BACKUP_COUNT', 5))
+QUERY_LOG_BATCH_SIZE = int(os.environ.get('QUERY_LOG_BATCH_SIZE', 100))
+QUERY_LOG_FLUSH_INTERVAL = float(os.environ.get('QUERY_LOG_FLUSH_INTERVAL', 1.0))
+QUERY_LOG_BUFFER_SIZE = int(os.environ.get('QUERY_LOG_BUFFER_SIZE', 10000))
+
+_STOP = object()
+
+
+class QueryLog:
+    """
+    Append-only JSON lines log written by a background thread.
+    Records are batched and flushed on batch size or flush interval, file is rotated by size.
+    When the buffer is full new records are dropped, callers are never blocked.
+    """
+
+    def __init__(self, path: str, max_bytes: int = QUERY_LOG_MAX_BYTES, backup_count: int = QUERY_LOG_BACKUP_COUNT,
+                 batch_size: int = QUERY_LOG_BATCH_SIZE, flush_interval: float = QUERY_LOG_FLUSH_INTERVAL,
+                 buffer_size: int = QUERY_LOG_BUFFER_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=buffer_size)
+        # Several dispatcher threads write records
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name='query-log-writer', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def write(self, record: dict) -> bool:
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+    def close(self) -> None:
+        # Stop marker is put even if buffer is full, all records before it are written
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def _run(self) -> None:
+        stopped = False
+        while not stopped:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    stopped = True
+                    break
+                batch.append(record)
+
+            if len(batch) > 0:
+                try:
+                    self._write_batch(batch)
+                except Exception:
+                    logger.exception(f'Failed to write {len(batch)} query log record(s)')
+
+    def _write_batch(self, batch: list) -> None:
+        lines = ''.join(json.dumps(record, ensure_ascii=False, default=str) + '\n' for record in batch)
+        with open(self.path, 'a', encoding='utf-8') as log_file:
+            log_file.write(lines)
+            size = log_file.tell()
+        if size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        if self.backup_count <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f'{self.path}.{index}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{index + 1}')
+        os.replace(self.path, f'{self.path}.1')
+
+
+QUERY_LOG = None
+if QUERY_LOG_PATH:
+    QUERY_LOG = QueryLog(QUERY_LOG_PATH)
+    QUERY_LOG.start()
+    atexit.register(QUERY_LOG.close)
+
+
+def log_query(record: dict) -> None:
+    if QUERY_LOG is not None:
+        QUERY_LOG.write(record)
+
+
+def get_stage_timings(spans: list) -> dict:
+    # Total milliseconds and count by span name
+    timings = {}
+    for name, duration in spans:
+        stage = timings.setdefault(name, {'ms': 0.0, 'count': 0})
+        stage['ms'] = round(stage.get('ms') + duration * 1000, 1)
+        stage['count'] += 1
+    return timings
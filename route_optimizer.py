@@ -0,0 +1,104 @@
+import math
+
+# Bigger sets are solved with nearest neighbour + 2-opt heuristic
+EXACT_SOLVER_LIMIT = 10
+
+
+def solve(matrix: list) -> tuple:
+    """
+    Fastest order to visit all nodes starting from node 0 (open path, no return).
+    matrix[i][j] is the cost from i to j, None if the leg is impossible.
+    Returns visiting order (without node 0) and total cost.
+    """
+    if len(matrix) <= 1:
+        return [], 0
+
+    if len(matrix) - 1 <= EXACT_SOLVER_LIMIT:
+        order = solve_exact(matrix)
+    else:
+        order = solve_heuristic(matrix)
+
+    cost = get_path_cost(matrix, order)
+    if order is None or math.isinf(cost):
+        raise RuntimeError('⚠️ Route could not be built ⚠️')
+    return order, cost
+
+
+def get_cost(matrix: list, source: int, target: int) -> float:
+    cost = matrix[source][target]
+    return math.inf if cost is None else cost
+
+
+def get_path_cost(matrix: list, order: list) -> float:
+    if order is None:
+        return math.inf
+    cost = 0
+    previous = 0
+    for node in order:
+        cost += get_cost(matrix, previous, node)
+        previous = node
+    return cost
+
+
+def solve_exact(matrix: list) -> list:
+    # Held-Karp dynamic programming over subsets of destinations
+    count = len(matrix) - 1
+    full = (1 << count) - 1
+    costs = {}
+    parents = {}
+    for node in range(count):
+        costs[(1 << node, node)] = get_cost(matrix, 0, node + 1)
+
+    for subset in range(1, full + 1):
+        for last in range(count):
+            if not subset & (1 << last) or (subset, last) not in costs:
+                continue
+            cost = costs[(subset, last)]
+            if math.isinf(cost):
+                continue
+            for node in range(count):
+                if subset & (1 << node):
+                    continue
+                key = (subset | (1 << node), node)
+                new_cost = cost + get_cost(matrix, last + 1, node + 1)
+                if new_cost < costs.get(key, math.inf):
+                    costs[key] = new_cost
+                    parents[key] = last
+
+    best_last = min(range(count), key=lambda node: costs.get((full, node), math.inf))
+    if math.isinf(costs.get((full, best_last), math.inf)):
+        return None
+
+    order = []
+    subset, last = full, best_last
+    while last is not None:
+        order.append(last + 1)
+        previous = parents.get((subset, last))
+        subset &= ~(1 << last)
+        last = previous
+    return order[::-1]
+
+
+def solve_heuristic(matrix: list) -> list:
+    # Nearest neighbour start
+    unvisited = set(range(1, len(matrix)))
+    order = []
+    current = 0
+    while unvisited:
+        current = min(unvisited, key=lambda node: (get_cost(matrix, current, node), node))
+        order.append(current)
+        unvisited.remove(current)
+
+    # 2-opt improvement (legs are reversed, so asymmetric costs are recalculated for full path)
+    best_cost = get_path_cost(matrix, order)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(order) - 1):
+            for j in range(i + 1, len(order)):
+                candidate = order[:i] + order[i:j + 1][::-1] + order[j + 1:]
+                candidate_cost = get_path_cost(matrix, candidate)
+                if candidate_cost < best_cost:
+                    order, best_cost = candidate, candidate_cost
+                    improved = True
+    return order
@@ -0,0 +1,194 @@
+import math
+import random
+import threading
+import time
+import unittest
+import aviapages_api
+import deadline
+from tests.fake_aviapages import FakeAviapagesServer
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+
+    def test_limit_grows_while_healthy(self):
+        limiter = aviapages_api.AdaptiveLimiter(initial_limit=2, min_limit=1, max_limit=4)
+        for _ in range(50):
+            # Keeping all slots busy
+            count = limiter.metrics().get('limit')
+            for _ in range(count):
+                limiter.acquire()
+            for _ in range(count):
+                limiter.release(0.1, 200)
+        self.assertEqual(limiter.metrics().get('limit'), 4)
+        self.assertEqual(limiter.metrics().get('in_flight'), 0)
+
+    def test_limit_backs_off(self):
+        limiter = aviapages_api.AdaptiveLimiter(initial_limit=8, min_limit=1, max_limit=16)
+        limiter.acquire()
+        limiter.release(0.0, 429)
+        self.assertEqual(limiter.metrics().get('limit'), 4)
+        limiter.acquire()
+        limiter.release(0.0, 503)
+        self.assertEqual(limiter.metrics().get('limit'), 2)
+        limiter.acquire()
+        limiter.release(0.0, None)
+        limiter.acquire()
+        limiter.release(0.0, None)
+        self.assertEqual(limiter.metrics().get('limit'), 1)
+
+    def test_limit_backs_off_on_latency(self):
+        limiter = aviapages_api.AdaptiveLimiter(initial_limit=8, min_limit=1, max_limit=16)
+        limiter.acquire()
+        limiter.release(0.01, 200)
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(1.0, 200)
+            limiter.last_decrease = 0.0
+        self.assertLess(limiter.metrics().get('limit'), 8)
+
+    def test_limit_grows_with_jittered_latency(self):
+        generator = random.Random(1)
+        limiter = aviapages_api.AdaptiveLimiter(initial_limit=8, min_limit=1, max_limit=16)
+        for _ in range(2000):
+            count = limiter.metrics().get('limit')
+            for _ in range(count):
+                limiter.acquire()
+            for _ in range(count):
+                limiter.release(generator.lognormvariate(math.log(0.1), 0.5), 200)
+            # Decreases are not rate limited by the clock
+            limiter.last_decrease = 0.0
+        self.assertEqual(limiter.metrics().get('limit'), 16)
+
+    def test_budget_timeout_is_not_congestion(self):
+        with FakeAviapagesServer(delay=0.5) as server:
+            request_url = f'{server.url}/api/airports/?search=KIV'
+            limit = aviapages_api.get_limiter(request_url).metrics().get('limit')
+            with deadline.start(1.0):
+                # Only 0.1s of the budget is left, less than half of 0.3s directory stage share
+                time.sleep(0.9)
+                with self.assertRaises(deadline.DeadlineExceeded):
+                    aviapages_api.api_get(request_url)
+            metrics = aviapages_api.get_limiter(request_url).metrics()
+        self.assertEqual(metrics.get('limit'), limit)
+        self.assertEqual(metrics.get('in_flight'), 0)
+
+
+class HedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hedger = aviapages_api.Hedger(percentile=0.9, max_rate=1.0)
+        for _ in range(aviapages_api.Hedger.MIN_SAMPLES):
+            self.hedger.add_latency(0.01)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def slow_first_call(self, value: str) -> str:
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+        if call == 1:
+            time.sleep(1)
+            return f'{value} slow'
+        return f'{value} fast'
+
+    def test_hedge_wins(self):
+        started = time.monotonic()
+        self.assertEqual(self.hedger.call(self.slow_first_call, 'reply'), 'reply fast')
+        self.assertLess(time.monotonic() - started, 0.5)
+        metrics = self.hedger.metrics()
+        self.assertEqual(metrics.get('requests'), 1)
+        self.assertEqual(metrics.get('hedges'), 1)
+        self.assertEqual(metrics.get('hedge_wins'), 1)
+
+    def test_hedge_loser_returns_slot(self):
+        with FakeAviapagesServer(delay=1, slow_queries=('search_iata',)) as server:
+            def lookup(value: str):
+                with self.lock:
+                    self.calls += 1
+                    call = self.calls
+                search = 'search_iata' if call == 1 else 'search_icao'
+                return aviapages_api.api_get(f'{server.url}/api/airports/?{search}={value}')
+
+            limit = aviapages_api.get_limiter(server.url).metrics().get('limit')
+            self.assertEqual(self.hedger.call(lookup, 'KIV').status_code, 200)
+            # Primary is still waiting for its reply, but its slot is already returned
+            self.assertEqual(aviapages_api.get_limiter(server.url).metrics().get('in_flight'), 0)
+            # Late reply of the loser is not released twice
+            time.sleep(1)
+            metrics = aviapages_api.get_limiter(server.url).metrics()
+        self.assertEqual(metrics.get('in_flight'), 0)
+        self.assertEqual(metrics.get('limit'), limit)
+
+    def test_hedge_rate_is_limited(self):
+        self.hedger.max_rate = 0.0
+        self.assertEqual(self.hedger.call(self.slow_first_call, 'reply'), 'reply slow')
+        self.assertEqual(self.hedger.metrics().get('hedges'), 0)
+
+    def test_no_hedge_without_samples(self):
+        hedger = aviapages_api.Hedger()
+        self.assertEqual(hedger.call(self.slow_first_call, 'reply'), 'reply slow')
+        self.assertEqual(hedger.metrics().get('hedges'), 0)
+
+
+def get_leg(departure: str, arrival: str, warnings: list) -> dict:
+    return {
+        'departure_airport': {'airport_icao': departure, 'airport_iata': departure[1:], 'airport_name': departure.title()},
+        'arrival_airport': {'airport_icao': arrival, 'airport_iata': arrival[1:], 'airport_name': arrival.title()},
+        'pax': 3,
+        'aircraft': 'E35L',
+        'avoid': {'countries': ['UKRAINE'], 'firs': []},
+        'airway_time': 60,
+        'airway_distance': 500.0,
+        'warnings': warnings
+    }
+
+
+class RenderTest(unittest.TestCase):
+
+    def test_warnings_deduplicated(self):
+        legs = [
+            get_leg('LUKK', 'EVRA', ['Long runway required']),
+            get_leg('EVRA', 'UUWW', ['Long runway required', 'Runway']),
+            get_leg('UUWW', 'LSGG', ['Runway'])
+        ]
+        message = aviapages_api.render_calculator_message(legs)
+        self.assertEqual(message.count('<b>Long runway required</b>'), 1)
+        # Warning which is a substring of another one is not lost
+        self.assertEqual(message.count('<b>Runway</b>'), 1)
+        self.assertEqual(message.count('Avoided countries'), 3)
+        self.assertIn(' ├ <b>Flight time</b>: 03:00\n', message)
+        self.assertTrue(message.endswith(' └ <b>Flight distance</b>: 1500km'))
+
+    def test_long_message_split(self):
+        legs = [get_leg('LUKK', 'EVRA', [f'Warning {index % 7}']) for index in range(100)]
+        messages = aviapages_api.render_calculator_messages(legs)
+        self.assertGreater(len(messages), 1)
+        for message in messages:
+            self.assertLessEqual(len(message), aviapages_api.MESSAGE_LIMIT)
+        self.assertEqual(''.join(messages), aviapages_api.render_calculator_message(legs))
+
+    def test_oversized_part_split(self):
+        messages = aviapages_api.split_message_parts(['a' * 10, 'b' * 25, 'c' * 5], limit=10)
+        self.assertEqual(messages, ['a' * 10, 'b' * 10, 'b' * 10, 'b' * 5 + 'c' * 5])
+
+    def test_oversized_warning_split(self):
+        legs = [get_leg('LUKK', 'EVRA', ['Fuel & payload limits. ' * 400])]
+        messages = aviapages_api.render_calculator_messages(legs)
+        self.assertGreater(len(messages), 2)
+        for message in messages:
+            self.assertLessEqual(len(message), aviapages_api.MESSAGE_LIMIT)
+            self.assertEqual(message.count('<b>'), message.count('</b>'))
+            self.assertEqual(message.count('&'), message.count('&amp;'))
+        self.assertEqual(''.join(messages).replace('</b><b>', ''), aviapages_api.render_calculator_message(legs))
+
+    def test_oversized_pre_split_by_lines(self):
+        part = '<pre>' + ''.join(f'row {index}\n' for index in range(10)) + '</pre>'
+        messages = aviapages_api.split_message_parts([part], limit=40)
+        self.assertEqual(messages[0], '<pre>row 0\nrow 1\nrow 2\nrow 3\n</pre>')
+        for message in messages:
+            self.assertLessEqual(len(message), 40)
+            self.assertTrue(message.startswith('<pre>') and message.endswith('</pre>'))
+
+
+if __name__ == '__main__':
+    unittest.main()
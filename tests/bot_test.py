@@ -0,0 +1,171 @@
+import logging
+import unittest
+
+import time
+
+import aviapages_api
+import bot
+import deadline
+import query_log
+from tests.fake_aviapages import FakeAviapagesServer, FakeBot, fake_update, fake_context
+
+
+class UserMessageTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.INFO)
+        self.handler = bot.TelegramHandler('test')
+        aviapages_api.AIRPORT_CACHE.clear()
+        aviapages_api.AVOID_CACHE.clear()
+        aviapages_api.CALCULATOR_CACHE.clear()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_edited_message_recalculates_changed_legs(self):
+        fake_bot = FakeBot()
+        query = '1. KIV-RIX 3 E35L\n2. RIX-VKO 3 CL30\n3. VKO-GVA 2 CL30'
+        edited_query = '1. KIV-RIX 3 E35L\n2. RIX-VKO 4 CL30\n3. VKO-GVA 2 CL30'
+        with FakeAviapagesServer() as server:
+            self.handler.user_message(fake_update(query, message_id=10), fake_context(fake_bot))
+            self.assertEqual(server.calculator_requests_count, 3)
+            self.assertEqual(len(fake_bot.messages), 1)
+
+            self.handler.user_message(fake_update(edited_query, message_id=10, edited=True), fake_context(fake_bot))
+            self.assertEqual(server.calculator_requests_count, 4)
+
+        self.assertEqual(len(fake_bot.messages), 1)
+        self.assertTrue(fake_bot.messages[0].get('edited'))
+        self.assertIn('Passengers: 4', fake_bot.messages[0].get('text'))
+
+    def test_edited_unknown_message_sends_reply(self):
+        fake_bot = FakeBot()
+        with FakeAviapagesServer():
+            self.handler.user_message(fake_update('KIV-RIX 3 E35L', message_id=20, edited=True), fake_context(fake_bot))
+        self.assertEqual(len(fake_bot.messages), 1)
+        self.assertIn('FLIGHT INFO', fake_bot.messages[0].get('text'))
+
+    def test_aircraft_comparison(self):
+        fake_bot = FakeBot()
+        with FakeAviapagesServer() as server:
+            self.handler.user_message(fake_update('KIV-RIX 2/4 E35L / CL30 / Global 5000'), fake_context(fake_bot))
+            self.assertEqual(server.calculator_requests_count, 6)
+            # Departure and arrival are resolved once
+            self.assertEqual(server.requests_count - server.calculator_requests_count, 6)
+        text = fake_bot.messages[0].get('text')
+        self.assertIn('FLIGHT COMPARISON', text)
+        for aircraft in ('E35L', 'CL30', 'GLOBAL 5000'):
+            self.assertIn(aircraft, text)
+
+    def test_route(self):
+        fake_bot = FakeBot()
+        with FakeAviapagesServer() as server:
+            self.handler.route(fake_update('/route'), fake_context(fake_bot, 'KIV - RIX, VKO, GVA 3 E35L'.split()))
+            # Origin to 3 airports and 3 airports between each other, impossible KIV-GVA leg is cached too
+            self.assertEqual(server.calculator_requests_count, 9)
+            self.handler.route(fake_update('/route'), fake_context(fake_bot, 'KIV - GVA, RIX, VKO 3 E35L'.split()))
+            self.assertEqual(server.calculator_requests_count, 9)
+        self.assertEqual(len(fake_bot.messages), 2)
+        self.assertIn('Fastest route</b>: LUKK ➡️', fake_bot.messages[0].get('text'))
+        # Order of airports in the query does not change the total
+        self.assertEqual(fake_bot.messages[0].get('text').split('Flight time')[1], fake_bot.messages[1].get('text').split('Flight time')[1])
+
+    def test_deadline_returns_finished_legs(self):
+        fake_bot = FakeBot()
+        query = '1. KIV-RIX 3 E35L\n2. VKO-GVA 3 E35L'
+        original_deadline = deadline.REQUEST_DEADLINE
+        deadline.REQUEST_DEADLINE = 0.5
+        try:
+            with FakeAviapagesServer(delay=2, slow_queries=('GVA',)):
+                started = time.monotonic()
+                self.handler.user_message(fake_update(query), fake_context(fake_bot))
+                self.assertLess(time.monotonic() - started, 1.5)
+        finally:
+            deadline.REQUEST_DEADLINE = original_deadline
+        text = fake_bot.messages[0].get('text')
+        self.assertIn('EVRA (RIX)', text)
+        self.assertNotIn('LSGG (GVA)', text)
+        self.assertIn('Timed out, not calculated leg(s): 2', text)
+
+    def test_bots_share_caches(self):
+        other_handler = bot.TelegramHandler('other')
+        fake_bot = FakeBot()
+        query = 'KIV-RIX 3 E35L no Ukraine'
+        with FakeAviapagesServer() as server:
+            self.handler.user_message(fake_update(query, message_id=30), fake_context(fake_bot))
+            lookups_count = server.requests_count - server.calculator_requests_count
+            other_handler.user_message(fake_update(query, message_id=30), fake_context(fake_bot))
+            # Airports and avoid are not requested again by the other bot
+            self.assertEqual(server.requests_count - server.calculator_requests_count, lookups_count)
+        # Edit history is separate for each bot
+        self.assertIsNotNone(self.handler.history.get(1, 30))
+        self.assertIsNot(self.handler.history.get(1, 30), other_handler.history.get(1, 30))
+        self.assertEqual(len(fake_bot.messages), 2)
+
+    def test_long_itinerary_split(self):
+        fake_bot = FakeBot()
+        query = '\n'.join('KIV-RIX 3 E35L no Ukraine' if index % 2 == 0 else 'RIX-KIV 3 E35L no Ukraine' for index in range(100))
+        with FakeAviapagesServer():
+            self.handler.user_message(fake_update(query, message_id=40), fake_context(fake_bot))
+            self.assertGreater(len(fake_bot.messages), 1)
+            for message in fake_bot.messages:
+                self.assertLessEqual(len(message.get('text')), aviapages_api.MESSAGE_LIMIT)
+            # Shorter edited query removes extra replies
+            self.handler.user_message(fake_update('KIV-RIX 3 E35L', message_id=40, edited=True), fake_context(fake_bot))
+        self.assertEqual(len(fake_bot.messages), 1)
+        self.assertTrue(fake_bot.messages[0].get('edited'))
+
+    def test_route_duplicate_airports(self):
+        fake_bot = FakeBot()
+        with FakeAviapagesServer():
+            self.handler.route(fake_update('/route'), fake_context(fake_bot, 'KIV - LUKK, RIX, EVRA 3 E35L'.split()))
+        text = fake_bot.messages[0].get('text')
+        self.assertIn('Fastest route</b>: LUKK ➡️ EVRA\n', text)
+        self.assertNotIn('LUKK (KIV), Chisinau ➡️ LUKK', text)
+
+    def test_route_airport_without_icao(self):
+        fake_bot = FakeBot()
+        with FakeAviapagesServer():
+            self.handler.route(fake_update('/route'), fake_context(fake_bot, 'KIV - QXB 3 E35L'.split()))
+        self.assertIn('Fastest route</b>: LUKK ➡️ QXB\n', fake_bot.messages[0].get('text'))
+
+    def test_route_leg_failure_is_reported(self):
+        fake_bot = FakeBot()
+        with FakeAviapagesServer(failing_legs=(('LUKK', 'EVRA'),)):
+            with self.assertRaises(RuntimeError) as e:
+                self.handler.route(fake_update('/route'), fake_context(fake_bot, 'KIV - RIX, VKO 3 E35L'.split()))
+        self.assertEqual(e.exception.args[0], '❗️ Connection failure ❗️')
+        self.assertEqual(len(fake_bot.messages), 0)
+
+    def test_route_is_logged(self):
+        fake_bot = FakeBot()
+        original_log = query_log.QUERY_LOG
+        # Writer thread is not started, records stay in the buffer
+        query_log.QUERY_LOG = query_log.QueryLog('')
+        try:
+            with FakeAviapagesServer():
+                self.handler.route(fake_update('/route'), fake_context(fake_bot, 'KIV - RIX, VKO 3 E35L no Ukraine'.split()))
+            record = query_log.QUERY_LOG.queue.get_nowait()
+        finally:
+            query_log.QUERY_LOG = original_log
+        self.assertEqual(record.get('command'), 'route')
+        self.assertEqual(record.get('query').get('arrival_airports'), ['RIX', 'VKO'])
+        self.assertEqual(record.get('order')[0], 'LUKK')
+        self.assertEqual(len(record.get('legs')), 2)
+        self.assertIn('POST', record.get('timings'))
+
+    def test_bot_without_tokens(self):
+        with self.assertRaises(ValueError):
+            bot.TelegramBot([])
+
+    def test_history_size_is_bounded(self):
+        history = bot.QueryHistory(size=2)
+        for message_id in range(5):
+            history.put(1, message_id, [], [], [message_id])
+        self.assertEqual(len(history), 2)
+        self.assertIsNone(history.get(1, 0))
+        self.assertIsNotNone(history.get(1, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import time
+import unittest
+
+import deadline
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def test_stage_share_is_shared_by_calls(self):
+        with deadline.start(1.0):
+            self.assertAlmostEqual(deadline.get_timeout('directory'), 0.3, delta=0.05)
+            time.sleep(0.2)
+            # Second call gets only what is left of the directory share
+            self.assertAlmostEqual(deadline.get_timeout('directory'), 0.1, delta=0.05)
+
+    def test_slow_directory_leaves_time_for_calculator(self):
+        with deadline.start(1.0):
+            deadline.get_timeout('directory')
+            # Sequential directory calls used the whole directory share
+            time.sleep(0.35)
+            with self.assertRaises(deadline.DeadlineExceeded):
+                deadline.get_timeout('directory')
+            self.assertAlmostEqual(deadline.get_timeout('calculator'), 0.5, delta=0.05)
+
+    def test_stage_share_is_capped_by_budget(self):
+        with deadline.start(1.0):
+            time.sleep(0.8)
+            self.assertLessEqual(deadline.get_timeout('calculator'), 0.2)
+
+    def test_no_deadline(self):
+        self.assertEqual(deadline.get_timeout('calculator'), deadline.API_TIMEOUT)
+
+
+if __name__ == '__main__':
+    unittest.main()
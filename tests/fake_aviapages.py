@@ -0,0 +1,170 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+
+import aviapages_api
+
+AIRPORTS = (
+    {'icao': 'LUKK', 'iata': 'KIV', 'name': 'Chisinau'},
+    {'icao': 'EVRA', 'iata': 'RIX', 'name': 'Riga'},
+    {'icao': 'UUWW', 'iata': 'VKO', 'name': 'Vnukovo'},
+    {'icao': 'LSGG', 'iata': 'GVA', 'name': 'Geneva'},
+    {'icao': 'EGLL', 'iata': 'LHR', 'name': 'Heathrow'},
+    {'icao': 'LFPB', 'iata': 'LBG', 'name': 'Le Bourget'},
+    {'icao': None, 'iata': 'QXB', 'name': 'Aix-en-Provence'},
+)
+COUNTRIES = ('UKRAINE', 'BELARUS', 'USA')
+# Legs rejected by the calculator
+IMPOSSIBLE_LEGS = ({'LUKK', 'LSGG'},)
+
+
+class FakeAviapagesServer:
+    """
+    Local HTTP server imitating directory and calculator aviapages endpoints.
+    """
+
+    def __init__(self, delay: float = 0.0, slow_queries: tuple = (), failing_legs: tuple = ()):
+        # Delay is applied to all requests or only to ones mentioning slow queries
+        self.delay = delay
+        self.slow_queries = slow_queries
+        # Calculator replies with 500 for these (departure, arrival) pairs
+        self.failing_legs = failing_legs
+        self.requests_count = 0
+        self.calculator_requests_count = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.original_urls = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def __enter__(self):
+        self.thread.start()
+        self.original_urls = (aviapages_api.DIRECTORY_URL, aviapages_api.CALCULATOR_URL)
+        aviapages_api.DIRECTORY_URL = self.url
+        aviapages_api.CALCULATOR_URL = self.url
+        return self
+
+    def __exit__(self, *args):
+        aviapages_api.DIRECTORY_URL, aviapages_api.CALCULATOR_URL = self.original_urls
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, body: dict, status: int = 200):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                fake.count_request(self.path)
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if url.path == '/api/airports/':
+                    query = next(iter(params.values()), '')
+                    results = [airport for airport in AIRPORTS if query.upper() in (airport.get('icao'), airport.get('iata'), airport.get('name').upper())]
+                    self._send({'count': len(results), 'results': results})
+                elif url.path == '/api/countries/':
+                    query = params.get('search', '')
+                    results = [{'name': query.title()}] if query in COUNTRIES else []
+                    self._send({'count': len(results), 'results': results})
+                else:
+                    self._send({}, 404)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                fake.count_request(json.dumps(body), calculator=True)
+                if self.path != '/flight_calculator/':
+                    self._send({}, 404)
+                    return
+                if (body.get('departure_airport'), body.get('arrival_airport')) in fake.failing_legs:
+                    self._send({}, 500)
+                    return
+                if {body.get('departure_airport'), body.get('arrival_airport')} in IMPOSSIBLE_LEGS:
+                    self._send({'errors': [{'message': 'Weight exceeded, please reduce payload or choose a techstop'}]})
+                    return
+                airway_time, airway_distance = fake_leg(body.get('departure_airport'), body.get('arrival_airport'), body.get('aircraft'))
+                self._send({
+                    'time': {'airway': airway_time},
+                    'distance': {'airway': airway_distance},
+                    'warnings': []
+                })
+
+        return Handler
+
+    def count_request(self, request: str, calculator: bool = False) -> None:
+        with self.lock:
+            self.requests_count += 1
+            if calculator:
+                self.calculator_requests_count += 1
+        if self.delay > 0 and (len(self.slow_queries) == 0 or any(query in request for query in self.slow_queries)):
+            time.sleep(self.delay)
+
+
+def fake_leg(departure: str, arrival: str, aircraft: str) -> tuple:
+    # Deterministic and symmetric time/distance for any pair of airports
+    codes = sorted((departure, arrival))
+    seed = sum(ord(char) * (index + 1) for index, char in enumerate(''.join(codes)))
+    airway_distance = float(300 + seed % 2500)
+    return int(airway_distance / (12 if aircraft.startswith('GLOBAL') else 10)), airway_distance
+
+
+class FakeBot:
+    """
+    Records every outgoing message instead of sending it to telegram.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = []
+        self.last_message_id = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self.lock:
+            self.last_message_id += 1
+            self.messages.append({'chat_id': chat_id, 'message_id': self.last_message_id, 'text': text})
+            return SimpleNamespace(chat_id=chat_id, message_id=self.last_message_id, text=text)
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        with self.lock:
+            for message in self.messages:
+                if message.get('chat_id') == chat_id and message.get('message_id') == message_id:
+                    message['text'] = text
+                    message['edited'] = True
+            return SimpleNamespace(chat_id=chat_id, message_id=message_id, text=text)
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        with self.lock:
+            self.messages = [message for message in self.messages
+                             if message.get('chat_id') != chat_id or message.get('message_id') != message_id]
+            return True
+
+
+def fake_update(text: str, chat_id: int = 1, update_id: int = 1, message_id: int = 1, edited: bool = False):
+    chat = SimpleNamespace(id=chat_id, full_name='Soak Test', username='soak_test')
+    message = SimpleNamespace(text=text, message_id=message_id, chat_id=chat_id)
+    return SimpleNamespace(update_id=update_id,
+                           message=None if edited else message,
+                           edited_message=message if edited else None,
+                           effective_chat=chat,
+                           effective_user=SimpleNamespace(id=chat_id))
+
+
+def fake_context(bot: FakeBot, args: list = None):
+    return SimpleNamespace(bot=bot, args=args or [], error=None)
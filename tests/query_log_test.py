@@ -0,0 +1,66 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import query_log
+
+
+class QueryLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'queries.jsonl')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_records_written(self):
+        log = query_log.QueryLog(self.path, flush_interval=0.01)
+        log.start()
+        for index in range(5):
+            self.assertTrue(log.write({'index': index, 'avoid': {'UKRAINE'}}))
+        log.close()
+        with open(self.path, encoding='utf-8') as log_file:
+            records = [json.loads(line) for line in log_file]
+        self.assertEqual([record.get('index') for record in records], list(range(5)))
+
+    def test_full_buffer_drops_records(self):
+        log = query_log.QueryLog(self.path, buffer_size=2)
+        self.assertTrue(log.write({'index': 0}))
+        self.assertTrue(log.write({'index': 1}))
+        self.assertFalse(log.write({'index': 2}))
+        self.assertEqual(log.dropped, 1)
+        log.start()
+        log.close()
+        with open(self.path, encoding='utf-8') as log_file:
+            self.assertEqual(len(log_file.readlines()), 2)
+
+    def test_dropped_counted_from_several_threads(self):
+        log = query_log.QueryLog(self.path, buffer_size=1)
+        log.write({'index': 0})
+        threads = [threading.Thread(target=lambda: [log.write({'index': index}) for index in range(1000)]) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(log.dropped, 8000)
+
+    def test_rotation(self):
+        log = query_log.QueryLog(self.path, max_bytes=100, backup_count=2, batch_size=1, flush_interval=0.01)
+        log.start()
+        for index in range(10):
+            log.write({'index': index, 'text': 'x' * 60})
+        log.close()
+        self.assertTrue(os.path.exists(f'{self.path}.1'))
+        self.assertTrue(os.path.exists(f'{self.path}.2'))
+        self.assertFalse(os.path.exists(f'{self.path}.3'))
+
+    def test_stage_timings(self):
+        timings = query_log.get_stage_timings([('GET', 0.1), ('GET', 0.2), ('POST', 0.05)])
+        self.assertEqual(timings, {'GET': {'ms': 300.0, 'count': 2}, 'POST': {'ms': 50.0, 'count': 1}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -231,6 +231,77 @@ class QueryTest(unittest.TestCase):
         self.assertEqual(INVALID_QUERY, e.exception.args[0])
 
 
+class ComparisonQueryTest(unittest.TestCase):
+
+    def test_correct_comparison_query(self):
+        query = 'KIV-RIX 3 E35L / CL30 / Global 5000'
+        answer = [{
+            'count': '',
+            'departure_airport': 'KIV',
+            'arrival_airport': 'RIX',
+            'pax': 3,
+            'aircraft': ['E35L', 'CL30', 'GLOBAL 5000'],
+            'avoid': set()
+        }]
+        self.assertEqual(bot.get_query_structure(query), answer)
+        query = 'KIV - RIX 2/6 pax E35L  /  CL30 no Ukraine'
+        answer = [{
+            'count': '',
+            'departure_airport': 'KIV',
+            'arrival_airport': 'RIX',
+            'pax': [2, 6],
+            'aircraft': ['E35L', 'CL30'],
+            'avoid': {'UKRAINE'}
+        }]
+        self.assertEqual(bot.get_query_structure(query), answer)
+
+    def test_slash_in_aircraft_name(self):
+        query = 'KIV-RIX 3 Hawker 800XP/850XP'
+        self.assertEqual(bot.get_query_structure(query)[0].get('aircraft'), 'HAWKER 800XP/850XP')
+
+    def test_identical_options(self):
+        query = 'KIV-RIX 2/2 E35L / e35l'
+        query_params = bot.get_query_structure(query)[0]
+        self.assertEqual(query_params.get('pax'), 2)
+        self.assertEqual(query_params.get('aircraft'), 'E35L')
+        self.assertEqual(aviapages_api.get_comparison_options({'pax': [2, 2], 'aircraft': ['E35L', 'E35L']}), [('E35L', 2)])
+
+    def test_incorrect_comparison_query(self):
+        query = 'KIV-RIX 3 E35L / CL'
+        with self.assertRaises(ValueError) as e:
+            bot.get_query_structure(query)
+        self.assertEqual(INVALID_QUERY, e.exception.args[0])
+        query = 'KIV-RIX 3 E35L / CL30\nRIX-VKO 3 E35L'
+        with self.assertRaises(ValueError) as e:
+            bot.get_query_structure(query)
+        self.assertEqual('⚠️ Aircraft comparison is supported for a single route only ⚠️', e.exception.args[0])
+
+
+class RouteQueryTest(unittest.TestCase):
+
+    def test_correct_route_query(self):
+        query = 'KIV - RIX, VKO,GVA 3 pax E35L no Ukraine'
+        answer = {
+            'count': '',
+            'departure_airport': 'KIV',
+            'arrival_airports': ['RIX', 'VKO', 'GVA'],
+            'pax': 3,
+            'aircraft': 'E35L',
+            'avoid': {'UKRAINE'}
+        }
+        self.assertEqual(bot.get_route_structure(query), answer)
+
+    def test_incorrect_route_query(self):
+        query = 'KIV - RIX, , GVA 3 E35L'
+        with self.assertRaises(ValueError) as e:
+            bot.get_route_structure(query)
+        self.assertEqual(INVALID_QUERY, e.exception.args[0])
+        query = 'KIV - KIV 3 E35L'
+        with self.assertRaises(ValueError) as e:
+            bot.get_route_structure(query)
+        self.assertEqual(INVALID_QUERY, e.exception.args[0])
+
+
 class APIRequestTest(unittest.TestCase):
     def test_airport_correct_request(self):
         query = 'UUWW'
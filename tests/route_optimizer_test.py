@@ -0,0 +1,53 @@
+import itertools
+import random
+import unittest
+
+import route_optimizer
+
+
+def brute_force(matrix: list) -> float:
+    return min(route_optimizer.get_path_cost(matrix, list(order)) for order in itertools.permutations(range(1, len(matrix))))
+
+
+def random_matrix(count: int, seed: int) -> list:
+    generator = random.Random(seed)
+    points = [(generator.uniform(0, 1000), generator.uniform(0, 1000)) for _ in range(count)]
+    return [[None if i == j else ((points[i][0] - points[j][0]) ** 2 + (points[i][1] - points[j][1]) ** 2) ** 0.5
+             for j in range(count)] for i in range(count)]
+
+
+class RouteOptimizerTest(unittest.TestCase):
+
+    def test_exact_solver(self):
+        for seed in range(5):
+            matrix = random_matrix(7, seed)
+            order, cost = route_optimizer.solve(matrix)
+            self.assertCountEqual(order, range(1, 7))
+            self.assertAlmostEqual(cost, brute_force(matrix))
+
+    def test_impossible_legs(self):
+        matrix = [
+            [None, 1, 10, 10],
+            [10, None, None, 1],
+            [10, 1, None, 10],
+            [10, 10, 1, None]
+        ]
+        # 1 -> 2 is impossible, the best order is 1 -> 3 -> 2
+        self.assertEqual(route_optimizer.solve(matrix), ([1, 3, 2], 3))
+        matrix = [
+            [None, None],
+            [None, None]
+        ]
+        with self.assertRaises(RuntimeError):
+            route_optimizer.solve(matrix)
+
+    def test_heuristic_solver(self):
+        matrix = random_matrix(14, 1)
+        order, cost = route_optimizer.solve(matrix)
+        self.assertCountEqual(order, range(1, 14))
+        # Heuristic is not worse than plain nearest neighbour
+        self.assertLessEqual(cost, route_optimizer.get_path_cost(matrix, list(range(1, 14))))
+
+
+if __name__ == '__main__':
+    unittest.main()
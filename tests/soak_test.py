@@ -0,0 +1,133 @@
+import gc
+import logging
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+import unittest
+
+import bot
+import query_log
+from tests.fake_aviapages import FakeAviapagesServer, FakeBot, fake_update, fake_context
+
+# Soak test is started only on demand, e.g. SOAK_DURATION=7200 python -m unittest tests.soak_test
+SOAK_DURATION = float(os.environ.get('SOAK_DURATION', 0))
+SOAK_RATE = float(os.environ.get('SOAK_RATE', 5))
+SOAK_SAMPLE_INTERVAL = float(os.environ.get('SOAK_SAMPLE_INTERVAL', 60))
+SOAK_WARMUP = float(os.environ.get('SOAK_WARMUP', min(60.0, SOAK_DURATION / 10)))
+SOAK_MAX_MEMORY_GROWTH_MB = float(os.environ.get('SOAK_MAX_MEMORY_GROWTH_MB', 20))
+SOAK_MAX_LATENCY_DRIFT = float(os.environ.get('SOAK_MAX_LATENCY_DRIFT', 1.5))
+SOAK_CHATS = int(os.environ.get('SOAK_CHATS', 50))
+
+QUERIES = (
+    'KIV - RIX 3 E35L',
+    'UUWW - EVRA 2Pax Challenger 300',
+    'GVA LHR 4 pax Global 5000 no Ukraine, Belarus',
+    '1. KIV-RIX 3 E35L\n2. RIX-VKO 3 Challenger 300\n3. VKO-GVA 2 CL30',
+)
+# Previous message is edited into a reply split into several messages and back into a single one
+EDITED_QUERIES = (
+    '\n'.join('KIV-RIX 3 E35L no Ukraine' if index % 2 == 0 else 'RIX-KIV 3 E35L no Ukraine' for index in range(60)),
+    'KIV-RIX 4 E35L',
+)
+# Passenger count changes, so the calculator cache keeps getting new entries
+ROUTES = (
+    'KIV - RIX, VKO, GVA {pax} E35L',
+    'GVA - LHR, LBG, RIX {pax} Global 5000 no Ukraine',
+)
+
+
+def get_rss_mb() -> float:
+    # Current (not peak) resident memory, linux only
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+@unittest.skipUnless(SOAK_DURATION > 0, 'SOAK_DURATION is not set')
+class SoakTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.INFO)
+        # Query log buffer and rotation are part of the workload
+        self.directory = tempfile.TemporaryDirectory()
+        self.original_log = query_log.QUERY_LOG
+        query_log.QUERY_LOG = query_log.QueryLog(os.path.join(self.directory.name, 'queries.jsonl'), max_bytes=1024 * 1024)
+        query_log.QUERY_LOG.start()
+
+    def tearDown(self):
+        query_log.QUERY_LOG.close()
+        query_log.QUERY_LOG = self.original_log
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    @staticmethod
+    def send_update(handler, fake_bot, iteration: int) -> None:
+        # New messages, edits of the previous message and routes are mixed
+        chat_id = iteration % SOAK_CHATS + 1
+        if iteration % 6 == 4:
+            update = fake_update(EDITED_QUERIES[iteration // 6 % len(EDITED_QUERIES)], chat_id=(iteration - 1) % SOAK_CHATS + 1,
+                                 update_id=iteration, message_id=iteration - 1, edited=True)
+            handler.user_message(update, fake_context(fake_bot))
+        elif iteration % 6 == 5:
+            route = ROUTES[iteration // 6 % len(ROUTES)].format(pax=iteration // 6 % 20 + 1)
+            handler.route(fake_update('/route', chat_id=chat_id, update_id=iteration), fake_context(fake_bot, route.split()))
+        else:
+            update = fake_update(QUERIES[iteration % len(QUERIES)], chat_id=chat_id, update_id=iteration, message_id=iteration)
+            handler.user_message(update, fake_context(fake_bot))
+
+    def test_soak(self):
+        fake_bot = FakeBot()
+        handler = bot.TelegramHandler('soak')
+        latencies = []
+        samples = []
+        baseline = None
+
+        tracemalloc.start()
+        with FakeAviapagesServer():
+            started = time.monotonic()
+            next_sample = started + SOAK_WARMUP
+            iteration = 0
+            while time.monotonic() - started < SOAK_DURATION:
+                iteration += 1
+                request_started = time.monotonic()
+                self.send_update(handler, fake_bot, iteration)
+                latencies.append(time.monotonic() - request_started)
+                # Replies are not needed, only latency and memory are tracked
+                fake_bot.messages.clear()
+
+                now = time.monotonic()
+                if now >= next_sample:
+                    gc.collect()
+                    snapshot = tracemalloc.take_snapshot()
+                    window = latencies[-max(1, int(SOAK_RATE * SOAK_SAMPLE_INTERVAL)):]
+                    samples.append((now - started, get_rss_mb(), statistics.median(window)))
+                    logging.getLogger('SOAK TEST').warning(
+                        f'{now - started:.0f}s: {iteration} requests, RSS {samples[-1][1]:.1f}MB, median latency {samples[-1][2] * 1000:.1f}ms')
+                    if baseline is None:
+                        baseline = snapshot
+                    else:
+                        last_snapshot = snapshot
+                    next_sample = now + SOAK_SAMPLE_INTERVAL
+
+                time.sleep(max(0.0, request_started + 1 / SOAK_RATE - time.monotonic()))
+        tracemalloc.stop()
+
+        self.assertGreaterEqual(len(samples), 2, 'Soak test is too short to take memory samples')
+        growth_mb = samples[-1][1] - samples[0][1]
+        top_growth = '\n'.join(str(stat) for stat in last_snapshot.compare_to(baseline, 'lineno')[:10])
+        self.assertLessEqual(growth_mb, SOAK_MAX_MEMORY_GROWTH_MB,
+                             f'RSS grew by {growth_mb:.1f}MB, top allocations:\n{top_growth}')
+        traced_growth_mb = sum(stat.size_diff for stat in last_snapshot.compare_to(baseline, 'filename')) / 1024 / 1024
+        self.assertLessEqual(traced_growth_mb, SOAK_MAX_MEMORY_GROWTH_MB,
+                             f'Python heap grew by {traced_growth_mb:.1f}MB, top allocations:\n{top_growth}')
+        latency_drift = samples[-1][2] / samples[0][2]
+        self.assertLessEqual(latency_drift, SOAK_MAX_LATENCY_DRIFT,
+                             f'Median latency drifted {latency_drift:.2f}x ({samples[0][2] * 1000:.1f}ms -> {samples[-1][2] * 1000:.1f}ms)')
+
+
+if __name__ == '__main__':
+    unittest.main()
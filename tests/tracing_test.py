@@ -0,0 +1,32 @@
+import unittest
+import tracing
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def test_profile_next_requests(self):
+        summaries = []
+        tracing.PROFILER.arm(2, summaries.append)
+        with tracing.start_trace('first') as trace:
+            self.assertTrue(trace.profiled)
+        self.assertEqual(summaries, [])
+        with tracing.start_trace('second') as trace:
+            self.assertTrue(trace.profiled)
+        self.assertEqual(len(summaries), 1)
+        self.assertIn('function calls', summaries[0])
+        with tracing.start_trace('third') as trace:
+            self.assertFalse(trace.profiled)
+        self.assertEqual(len(summaries), 1)
+
+    def test_spans_recorded(self):
+        with tracing.start_trace('request') as trace:
+            with tracing.span('first'):
+                pass
+            with tracing.span('second', 'details'):
+                pass
+        self.assertEqual([name for name, _ in trace.spans], ['first', 'second'])
+        self.assertIsNone(tracing.current_trace())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import contextvars
+import cProfile
+import html
+import io
+import logging
+import pstats
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger('TRACING')
+
+PROFILE_TOP_FUNCTIONS = 20
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace:
+    def __init__(self, name: str, update_id=None):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.update_id = update_id
+        self.spans = []
+        self.profiled = False
+        self.started = time.perf_counter()
+
+    def add_span(self, name: str, duration: float) -> None:
+        self.spans.append((name, duration))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def current_trace_id() -> str:
+    trace = _current_trace.get()
+    return trace.trace_id if trace else '-'
+
+
+@contextmanager
+def start_trace(name: str, update_id=None):
+    trace = Trace(name, update_id)
+    token = _current_trace.set(trace)
+    logger.info(f'[{trace.trace_id}] {name} started (update {update_id})')
+    try:
+        if PROFILER.acquire():
+            trace.profiled = True
+            with PROFILER.profiled():
+                yield trace
+        else:
+            yield trace
+    finally:
+        if trace.profiled:
+            PROFILER.release()
+        logger.info(f'[{trace.trace_id}] {name} finished in {trace.elapsed() * 1000:.1f}ms')
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, details: str = ''):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(name, duration)
+        logger.info(f'[{current_trace_id()}] {name}{f" {details}" if details else ""} took {duration * 1000:.1f}ms')
+
+
+def bind(function):
+    """
+    Wraps function to run in another thread within the current trace.
+    Work done in other threads is profiled together with the request that started it.
+    """
+    context = contextvars.copy_context()
+    trace = _current_trace.get()
+
+    def run(*args, **kwargs):
+        if trace is not None and trace.profiled:
+            with PROFILER.profiled():
+                return context.copy().run(function, *args, **kwargs)
+        return context.copy().run(function, *args, **kwargs)
+
+    return run
+
+
+class Profiler:
+    """
+    Collects cProfile statistics for the next N traced requests.
+    Once all of them are finished the summary is passed to the registered callback.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = 0
+        self.active = 0
+        self.stats = None
+        self.callback = None
+
+    def arm(self, count: int, callback) -> None:
+        with self.lock:
+            self.remaining = count
+            self.stats = None
+            self.callback = callback
+
+    def acquire(self) -> bool:
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            self.active += 1
+            return True
+
+    def release(self) -> None:
+        with self.lock:
+            self.active -= 1
+            if self.remaining > 0 or self.active > 0 or self.callback is None:
+                return
+            callback = self.callback
+            summary = self.summary()
+            self.callback = None
+            self.stats = None
+        callback(summary)
+
+    @contextmanager
+    def profiled(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def summary(self) -> str:
+        if self.stats is None:
+            return 'No profiling data collected'
+        stream = io.StringIO()
+        self.stats.stream = stream
+        self.stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        return stream.getvalue()
+
+
+PROFILER = Profiler()
+
+
+def format_profile_summary(summary: str, limit: int = 3500) -> str:
+    # Removing empty lines and keeping the message inside telegram limits
+    text = '\n'.join(line for line in summary.split('\n') if line.strip())
+    if len(text) > limit:
+        text = text[:limit] + '\n...'
+    return f'<pre>{html.escape(text)}</pre>'